@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+##
+##  parser benchmark for mcproxy
+##
+##  generates synthetic protocol 29 streams and measures
+##  how fast MCParser and the loggers can consume them.
+##
+##  usage: python mcbench.py [-m mix] [-n megabytes] [-b bufsize] [-r repeat]
+##         python mcbench.py -m chunks -o server.bin
+##
+
+import sys, time, zlib, random
+from struct import pack
+import mcproxy
+
+
+def str16(s):
+    data = s.encode('utf-16be')
+    return pack('>h', len(data)/2)+data
+
+
+##  TrafficGenerator
+##
+class TrafficGenerator(object):
+
+    GROUPS = ('chunk', 'move', 'spawn', 'items', 'chat', 'status',
+              'clientpos', 'clientlook', 'clientchat', 'click')
+
+    # weights of the packet groups.
+    MIXES = {
+        'server': {'chunk':1, 'move':60, 'spawn':5, 'items':2, 'chat':3, 'status':5},
+        'chunks': {'chunk':1},
+        'moves': {'move':1},
+        'items': {'items':1},
+        'chat': {'chat':1},
+        'client': {'clientpos':20, 'clientlook':5, 'clientchat':1, 'click':1},
+        }
+
+    ENCHANTED = [0x10C, 0x110, 0x114, 0x105, 0x12A, 0x136]
+    WORDS = u'hello world where is the diamond mine let us go home now'.split()
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.npackets = 0
+        self._eid = 100
+        self._chunks = [ self._make_chunk() for _ in xrange(8) ]
+        return
+
+    def _make_chunk(self):
+        # a chunk column: stone at the bottom, air at the top, some ores.
+        r = self.random
+        blocks = ''.join( chr(r.choice((1,1,1,1,3,13,14,15,16))) * 64 + '\x00' * 64
+                          for _ in xrange(16*16) )
+        nibbles = ''.join( chr(r.randrange(256)) for _ in xrange(16*16*128*3/2/64) ) * 64
+        return zlib.compress(blocks+nibbles)
+
+    def login(self):
+        self.npackets += 6
+        return ('\x01'+pack('>i', 1234)+str16(u'')+str16(u'default')+
+                pack('>iibBB', 0, 0, 1, 128, 20) +
+                '\x06'+pack('>iii', 0, 64, 0) +
+                '\x04'+pack('>q', 6000) +
+                '\xca'+pack('>bbbb', 0, 0, 0, 0) +
+                '\x08'+pack('>hhf', 20, 20, 5.0) +
+                '\x0d'+pack('>ddddffB', 0.5, 65.62, 64.0, 0.5, 0.0, 0.0, 1))
+
+    def chunk(self):
+        r = self.random
+        (x,z) = (r.randrange(-20, 20), r.randrange(-20, 20))
+        data = r.choice(self._chunks)
+        self.npackets += 2
+        return ('\x32'+pack('>iib', x, z, 1) +
+                '\x33'+pack('>iibHHii', x, z, 1, 0xff, 0, len(data), 0)+data)
+
+    def move(self):
+        r = self.random
+        eid = self._eid + r.randrange(50)
+        k = r.randrange(10)
+        self.npackets += 1
+        if k < 4:
+            return '\x1f'+pack('>ibbb', eid, r.randrange(-4,4), 0, r.randrange(-4,4))
+        elif k < 6:
+            return '\x21'+pack('>ibbbbb', eid, 1, 0, -1, r.randrange(128), 0)
+        elif k < 7:
+            return '\x20'+pack('>ibb', eid, r.randrange(128), 0)
+        elif k < 8:
+            return '\x22'+pack('>iiiibb', eid, r.randrange(10000), 2048, r.randrange(10000), 0, 0)
+        elif k < 9:
+            return '\x1c'+pack('>ihhh', eid, 0, -100, 0)
+        else:
+            return '\x23'+pack('>ib', eid, r.randrange(128))
+
+    def spawn(self):
+        r = self.random
+        self._eid += 1
+        self.npackets += 2
+        meta = '\x00\x00' + '\x21'+pack('>h', 300) + '\x7f'
+        return ('\x18'+pack('>ibiiibbb', self._eid, r.choice((50,51,52,90,91)),
+                            r.randrange(-3200, 3200), 2048, r.randrange(-3200, 3200), 0, 0, 0)+meta +
+                '\x28'+pack('>i', self._eid)+'\x00\x00\x7f')
+
+    def slot(self):
+        r = self.random
+        k = r.randrange(3)
+        if k == 0:
+            return pack('>h', -1)
+        elif k == 1:
+            return pack('>hbh', r.randrange(1, 100), r.randrange(1, 65), 0)
+        else:
+            nbt = zlib.compress('\x0a\x00\x00\x09\x00\x04ench\x0a\x00\x00\x00\x01'
+                                '\x02\x00\x02id\x00\x10\x02\x00\x03lvl\x00\x03\x00\x00')
+            return pack('>hbhh', r.choice(self.ENCHANTED), 1, r.randrange(100), len(nbt))+nbt
+
+    def items(self):
+        n = 45
+        self.npackets += 1
+        return '\x68'+pack('>bh', 0, n)+''.join( self.slot() for _ in xrange(n) )
+
+    def chat(self):
+        r = self.random
+        words = [ r.choice(self.WORDS) for _ in xrange(r.randrange(1, 12)) ]
+        self.npackets += 1
+        return '\x03'+str16(u'<\xa7eplayer%d\xa7f> %s' % (r.randrange(10), u' '.join(words)))
+
+    def status(self):
+        r = self.random
+        self.npackets += 3
+        return ('\x00'+pack('>i', r.randrange(1<<30)) +
+                '\x04'+pack('>q', r.randrange(24000*10)) +
+                '\x08'+pack('>hhf', r.randrange(1, 21), r.randrange(21), 2.0))
+
+    def clientpos(self):
+        r = self.random
+        self.npackets += 1
+        y = 64+r.random()
+        return '\x0b'+pack('>ddddB', r.uniform(-500, 500), y, y+1.62, r.uniform(-500, 500), 1)
+
+    def clientlook(self):
+        r = self.random
+        self.npackets += 1
+        y = 64+r.random()
+        return '\x0d'+pack('>ddddffB', r.uniform(-500, 500), y, y+1.62, r.uniform(-500, 500),
+                           r.uniform(0, 360), r.uniform(-90, 90), 1)
+
+    def clientchat(self):
+        self.npackets += 1
+        return '\x03'+str16(u' '.join(self.random.sample(self.WORDS, 5)))
+
+    def click(self):
+        self.npackets += 1
+        return '\x66'+pack('>bhbhb', 0, self.random.randrange(45), 0, 1, 0)+self.slot()
+
+    def generate(self, nbytes, mix):
+        groups = sorted(mix.iteritems())
+        total = sum( w for (_,w) in groups )
+        r = self.random
+        out = [self.login()]
+        size = len(out[0])
+        while size < nbytes:
+            x = r.uniform(0, total)
+            for (name,w) in groups:
+                x -= w
+                if x <= 0: break
+            data = getattr(self, name)()
+            out.append(data)
+            size += len(data)
+        return ''.join(out)
+
+
+##  NullFile
+##
+class NullFile(object):
+    def write(self, s): return
+    def flush(self): return
+
+
+def bench(klass, data, bufsize, repeat):
+    best = None
+    for _ in xrange(repeat):
+        # a protocol error must fail the benchmark, not stop the parser.
+        if issubclass(klass, mcproxy.MCLogger):
+            parser = klass(NullFile(), safemode=False)
+        else:
+            parser = klass(safemode=False)
+        stdout = sys.stdout
+        sys.stdout = NullFile()
+        try:
+            t0 = time.time()
+            for i in xrange(0, len(data), bufsize):
+                parser.feed(data[i:i+bufsize])
+            t = time.time()-t0
+        finally:
+            sys.stdout = stdout
+        assert parser.tell() == len(data), 'out of sync at %d' % parser.tell()
+        if best is None or t < best:
+            best = t
+    return max(best, 1e-6)
+
+def parse_mix(v):
+    if v in TrafficGenerator.MIXES:
+        return TrafficGenerator.MIXES[v]
+    mix = {}
+    for x in v.split(','):
+        (k,w) = x.split('=')
+        if k not in TrafficGenerator.GROUPS: raise ValueError(k)
+        mix[k] = float(w)
+    return mix
+
+def main(argv):
+    import getopt
+    def usage():
+        print ('usage: %s [-m mix] [-n megabytes] [-b bufsize] [-r repeat] [-s seed] [-o output]' %
+               argv[0])
+        print 'mixes: %s' % ', '.join(sorted(TrafficGenerator.MIXES))
+        print '   or: group=weight,... (groups: %s)' % ', '.join(TrafficGenerator.GROUPS)
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'm:n:b:r:s:o:')
+    except getopt.GetoptError:
+        return usage()
+    mixes = []
+    nbytes = 4*1024*1024
+    bufsize = 4096
+    repeat = 3
+    seed = 0
+    output = None
+    for (k, v) in opts:
+        if k == '-m': mixes.append(v)
+        elif k == '-n': nbytes = int(float(v)*1024*1024)
+        elif k == '-b': bufsize = int(v)
+        elif k == '-r': repeat = int(v)
+        elif k == '-s': seed = int(v)
+        elif k == '-o': output = v
+    if not mixes:
+        mixes = ['server', 'chunks', 'moves', 'items', 'chat', 'client']
+    for name in mixes:
+        try:
+            mix = parse_mix(name)
+        except ValueError:
+            return usage()
+        gen = TrafficGenerator(seed)
+        data = gen.generate(nbytes, mix)
+        if output is not None:
+            fp = file(output, 'wb')
+            fp.write(data)
+            fp.close()
+            print >>sys.stderr, 'written: %r (%d bytes, %d packets)' % (output, len(data), gen.npackets)
+            continue
+        if name == 'client':
+            klasses = [mcproxy.MCParser, mcproxy.MCClientLogger]
+        else:
+            klasses = [mcproxy.MCParser, mcproxy.MCServerLogger]
+        for klass in klasses:
+            t = bench(klass, data, bufsize, repeat)
+            print '%-8s %-16s %8.2f MB/s %10.0f packets/s' % (
+                name, klass.__name__, len(data)/t/1024/1024, gen.npackets/t)
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+##
+##  log indexer for mcproxy
+##
+##  builds an index next to each mclog-*.txt file and answers
+##  time range, word and player queries without reading whole logs.
+##  the index is updated incrementally as the log grows.
+##
+##  usage: python mcindex.py mclog-*.txt
+##         python mcindex.py [-T start,end] [-w word] [-p player] mclog-*.txt
+##
+
+import sys, os, os.path, glob
+import re
+import time
+import marshal
+import mcproxy
+
+
+# a log line: timestamp, optional session tag and the message.
+LINE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)(?: \[(\d+)\])? (.*)$')
+# a chat message. every session gets the chat of all the players.
+CHAT = re.compile(r'^<([^>]+)> ')
+# the player of a session, logged when the client logs in.
+LOGIN = ' @@@ login: '
+WORD = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    return WORD.findall(text.decode('utf-8', 'replace').lower())
+
+
+##  LogLine
+##
+class LogLine(object):
+
+    def __init__(self):
+        # the same second appears on many lines.
+        self._stamp = None
+        self._t = None
+        return
+
+    # returns (t, session, text, player, words) or None.
+    # player is only given by a login line.
+    def parse(self, line):
+        m = LINE.match(line)
+        if m is None: return None
+        (stamp, session, text) = m.groups()
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self._t = time.mktime(time.strptime(stamp, '%Y-%m-%d %H:%M:%S'))
+        if text.startswith(LOGIN):
+            player = text[len(LOGIN):].rstrip('\r\n').decode('utf-8', 'replace')
+            return (self._t, session, text, player, ())
+        # other events start with a space.
+        if text.startswith(' '):
+            return (self._t, session, text, None, ())
+        if text.startswith('>> '):
+            return (self._t, session, text, None, tokenize(text[3:]))
+        m = CHAT.match(text)
+        if m is not None:
+            text = text[m.end():]
+        return (self._t, session, text, None, tokenize(text))
+
+
+##  LogIndex
+##
+##  A log is split into blocks of about BLOCK_SIZE bytes at line
+##  boundaries. The index has for each block its offset, size and
+##  time range, and for each word and session tag the list of the
+##  blocks that have it. It also has the login lines as
+##  (offset, session tag, player). Session tags start over when the
+##  proxy restarts, so the lines of a tag belong to the player of
+##  its last login line before them.
+##
+class LogIndex(object):
+
+    VERSION = 2
+    BLOCK_SIZE = 65536
+
+    def __init__(self, path):
+        self.path = path
+        self.indexpath = path+'.mci'
+        self.size = 0
+        self.blocks = []
+        self.words = {}
+        self.sessions = {}
+        self.logins = []
+        return
+
+    def load(self):
+        try:
+            fp = file(self.indexpath, 'rb')
+            data = marshal.load(fp)
+            fp.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if data.get('version') != self.VERSION: return False
+        # the log has been rewritten.
+        if os.path.getsize(self.path) < data['size']: return False
+        self.size = data['size']
+        self.blocks = data['blocks']
+        self.words = data['words']
+        self.sessions = data['sessions']
+        self.logins = data['logins']
+        return True
+
+    def save(self):
+        data = {'version': self.VERSION, 'size': self.size, 'blocks': self.blocks,
+                'words': self.words, 'sessions': self.sessions,
+                'logins': self.logins}
+        tmppath = self.indexpath+'.tmp'
+        fp = file(tmppath, 'wb')
+        marshal.dump(data, fp)
+        fp.close()
+        os.rename(tmppath, self.indexpath)
+        return
+
+    # indexes the lines added since the last update.
+    # returns the number of bytes read.
+    def update(self):
+        if self.blocks:
+            # the last block may have grown.
+            (offset, size, _, _) = self.blocks[-1]
+            if offset+size == self.size and size < self.BLOCK_SIZE:
+                self._drop_last()
+        fp = file(self.path, 'rb')
+        fp.seek(self.size)
+        parser = LogLine()
+        start = self.size
+        block = None
+        for line in fp:
+            # an incomplete line is left for the next time.
+            if not line.endswith('\n'): break
+            if block is None:
+                block = (start, set(), set(), [None, None])
+            (offset, words, tags, trange) = block
+            rec = parser.parse(line)
+            if rec is not None:
+                (t, session, _, player, tokens) = rec
+                if trange[0] is None or t < trange[0]:
+                    trange[0] = t
+                if trange[1] is None or trange[1] < t:
+                    trange[1] = t
+                words.update(tokens)
+                if session is not None:
+                    tags.add(session)
+                if player is not None:
+                    self.logins.append((start, session, player))
+            start += len(line)
+            if self.BLOCK_SIZE <= start-offset:
+                self._add_block(block, start)
+                block = None
+        fp.close()
+        if block is not None:
+            self._add_block(block, start)
+        nbytes = start-self.size
+        self.size = start
+        return nbytes
+
+    def _add_block(self, (offset, words, sessions, (tmin, tmax)), end):
+        i = len(self.blocks)
+        self.blocks.append((offset, end-offset, tmin, tmax))
+        for (index, keys) in ((self.words, words), (self.sessions, sessions)):
+            for k in keys:
+                index.setdefault(k, []).append(i)
+        return
+
+    def _drop_last(self):
+        i = len(self.blocks)-1
+        (offset, _, _, _) = self.blocks.pop()
+        # the block numbers are in order, so it is always the last one.
+        for index in (self.words, self.sessions):
+            for (k, blocks) in index.items():
+                if blocks[-1] == i:
+                    blocks.pop()
+                    if not blocks:
+                        del index[k]
+        self.logins = [ x for x in self.logins if x[0] < offset ]
+        self.size = offset
+        return
+
+    # returns the (session tag, start, end) byte ranges of a player.
+    def player_ranges(self, player):
+        ranges = []
+        for (i, (offset, session, p)) in enumerate(self.logins):
+            if p != player: continue
+            end = None
+            for (offset1, session1, _) in self.logins[i+1:]:
+                if session1 == session:
+                    end = offset1
+                    break
+            ranges.append((session, offset, end))
+        return ranges
+
+    # returns the blocks that may have the matching lines.
+    def find(self, start=None, end=None, words=(), player=None):
+        # the workers append to a log, so blocks can overlap in time.
+        found = set( i for (i,block) in enumerate(self.blocks)
+                     if self._overlaps(block, start, end) )
+        for w in words:
+            found.intersection_update(self.words.get(w, ()))
+        if player is not None:
+            blocks = set()
+            for (session, offset, end) in self.player_ranges(player):
+                for i in self.sessions.get(session, ()):
+                    (offset1, size, _, _) = self.blocks[i]
+                    if offset < offset1+size and (end is None or offset1 < end):
+                        blocks.add(i)
+            found.intersection_update(blocks)
+        return [ self.blocks[i] for i in sorted(found) ]
+
+    def _overlaps(self, (_, _size, tmin, tmax), start, end):
+        if tmin is None: return False
+        if start is not None and tmax < start: return False
+        if end is not None and end <= tmin: return False
+        return True
+
+
+# yields the matching lines of a log.
+def query(path, start=None, end=None, words=(), player=None):
+    index = LogIndex(path)
+    index.load()
+    # the lines after the saved index are indexed in memory.
+    index.update()
+    words = set(words)
+    # ascii words can be looked for before a line is parsed.
+    needles = [ w.encode('ascii') for w in words if max(w) < u'\x80' ]
+    ranges = {}
+    if player is not None:
+        for (session, offset, end1) in index.player_ranges(player):
+            ranges.setdefault(session, []).append((offset, end1))
+    parser = LogLine()
+    fp = file(path, 'rb')
+    for (offset, size, _, _) in index.find(start, end, words, player):
+        fp.seek(offset)
+        for line in fp.read(size).splitlines(True):
+            pos = offset
+            offset += len(line)
+            if needles:
+                s = line.lower()
+                if not all( w in s for w in needles ): continue
+            rec = parser.parse(line)
+            if rec is None: continue
+            (t, session, _, _, tokens) = rec
+            if start is not None and t < start: continue
+            if end is not None and end <= t: continue
+            if words and not words.issubset(tokens): continue
+            if player is not None:
+                if not any( o0 <= pos and (o1 is None or pos < o1)
+                            for (o0, o1) in ranges.get(session, ()) ): continue
+            yield line
+    fp.close()
+    return
+
+def main(argv):
+    import getopt
+    def usage():
+        print 'usage: %s [-v] logfile ...' % argv[0]
+        print '       %s [-T start,end] [-w word] [-p player] logfile ...' % argv[0]
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'vT:w:p:')
+    except getopt.GetoptError:
+        return usage()
+    verbose = False
+    (start, end) = (None, None)
+    words = []
+    player = None
+    for (k, v) in opts:
+        if k == '-v': verbose = True
+        elif k == '-T': (start, end) = [ mcproxy.parse_time(x) for x in (v.split(',')+[''])[:2] ]
+        elif k == '-w': words.extend(tokenize(v))
+        elif k == '-p': player = v.decode('utf-8')
+    paths = []
+    for v in args:
+        paths.extend(sorted(glob.glob(v)) or [v])
+    if not paths: return usage()
+    if start is None and end is None and not words and player is None:
+        for path in paths:
+            index = LogIndex(path)
+            index.load()
+            t0 = time.time()
+            nbytes = index.update()
+            if nbytes:
+                index.save()
+            if verbose:
+                print >>sys.stderr, 'indexed: %r (%d bytes, %d blocks, %.2fs)' % (
+                    path, nbytes, len(index.blocks), time.time()-t0)
+        return 0
+    for path in paths:
+        for line in query(path, start=start, end=end, words=words, player=player):
+            sys.stdout.write(line)
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -8,12 +8,24 @@
 ##  usage: $ python mcproxy.py mcserver.example.com
 ##
 
-import sys, os, os.path
+import sys, os, os.path, glob
+import bisect
+import collections
 import re
+import zlib
 import time
+import random
 import socket
-import asyncore
-from struct import pack, unpack
+import select
+import errno
+import heapq
+import traceback
+import threading
+import ctypes, ctypes.util
+import signal
+import weakref
+import multiprocessing
+from struct import pack, unpack, Struct
 
 
 def toshort(x):
@@ -27,6 +39,84 @@ def touni(x):
 def dist((x0,y0,z0),(x1,y1,z1)):
     return abs(x0-x1)+abs(y0-y1)+abs(z0-z1)
 
+# the distance of p from the line through a and b.
+def linedist((x0,y0,z0),(x1,y1,z1),(x,y,z)):
+    (dx,dy,dz) = (x1-x0, y1-y0, z1-z0)
+    (px,py,pz) = (x-x0, y-y0, z-z0)
+    d = dx*dx+dy*dy+dz*dz
+    if d == 0:
+        return (px*px+py*py+pz*pz)**0.5
+    (cx,cy,cz) = (dy*pz-dz*py, dz*px-dx*pz, dx*py-dy*px)
+    return ((cx*cx+cy*cy+cz*cz)/float(d))**0.5
+
+# returns the indices of the points that the Douglas-Peucker
+# algorithm keeps. the end points are always kept.
+def simplify(points, tolerance):
+    n = len(points)
+    if n <= 2: return range(n)
+    keep = [0, n-1]
+    stack = [(0, n-1)]
+    while stack:
+        (i0, i1) = stack.pop()
+        (dmax, imax) = (0, None)
+        for i in xrange(i0+1, i1):
+            d = linedist(points[i0], points[i1], points[i])
+            if dmax < d:
+                (dmax, imax) = (d, i)
+        if imax is not None and tolerance < dmax:
+            keep.append(imax)
+            stack.append((i0, imax))
+            stack.append((imax, i1))
+    keep.sort()
+    return keep
+
+
+##  Packet schema
+##
+##  Each packet is described as a sequence of fields.
+##  A field is either a struct format string (fixed-size fields)
+##  or one of the following variable-length types:
+##
+STR16 = 'str16'                 # short length + UTF-16BE string.
+SLOT = 'slot'                   # slot data.
+META = 'meta'                   # entity metadata.
+BYTES = 'bytes'                 # (BYTES, k, m): byte array of values[k]*m bytes.
+SLOTS = 'slots'                 # (SLOTS, k): array of values[k] slots.
+IF = 'if'                       # (IF, k, fmt): fields present if 0 < values[k].
+
+_structs = {}
+def getstruct(fmt):
+    try:
+        return _structs[fmt]
+    except KeyError:
+        s = _structs[fmt] = Struct('>'+fmt)
+        return s
+SHORT = getstruct('h')
+SLOTINFO = getstruct('bh')
+
+# turns a packet schema into a list of (type, arg) operations.
+# consecutive fixed-size fields are merged into one struct.
+def compile_packet(fields):
+    ops = []
+    fmt = ''
+    for f in fields:
+        if isinstance(f, str) and f not in (STR16, SLOT, META):
+            fmt += f
+            continue
+        if fmt:
+            ops.append((None, getstruct(fmt)))
+            fmt = ''
+        if isinstance(f, tuple):
+            if f[0] == IF:
+                ops.append((IF, (f[1], getstruct(f[2]))))
+            else:
+                ops.append((f[0], f[1:]))
+        else:
+            ops.append((f, None))
+    if fmt:
+        ops.append((None, getstruct(fmt)))
+    return ops
+
 
 ##  MCParser
 ##  (for Protocol. cf. http://mc.kev009.com/wiki/index.php?title=Protocol&oldid=1810)
@@ -34,73 +124,485 @@ def dist((x0,y0,z0),(x1,y1,z1)):
 class MCParser(object):
 
     debugfp = None
+    collect_stats = False
 
     class MCParserError(Exception): pass
     class ProtocolError(MCParserError): pass
+    class IncompleteError(MCParserError): pass
+
+    PACKETS = {
+        0x00: ('i',),                   # keep alive
+        0x01: ('i', STR16, STR16, 'iibBB'), # login request
+        0x02: (STR16,),                 # handshake
+        0x03: (STR16,),                 # chat message
+        0x04: ('q',),                   # time update
+        0x05: ('ihhh',),                # entity equipment
+        0x06: ('iii',),                 # spawn position
+        0x07: ('iib',),                 # use entity
+        0x08: ('hhf',),                 # update health
+        0x09: ('ibbh', STR16),          # respawn
+        0x0a: ('B',),                   # player
+        0x0b: ('ddddB',),               # player position
+        0x0c: ('ffB',),                 # player look
+        0x0d: ('ddddffB',),             # player position & look
+        0x0e: ('bibib',),               # player digging
+        0x0f: ('ibib', SLOT),           # player block placement
+        0x10: ('h',),                   # holding change
+        0x11: ('ibibi',),               # use bed
+        0x12: ('ib',),                  # animation
+        0x13: ('ib',),                  # entity action
+        0x14: ('i', STR16, 'iiibbh'),   # named entity spawn
+        0x15: ('ihbhiiibbb',),          # pickup spawn
+        0x16: ('ii',),                  # collect item
+        0x17: ('ibiiii', (IF, 5, 'hhh')), # add object/vehicle
+        0x18: ('ibiiibbb', META),       # mob spawn
+        0x19: ('i', STR16, 'iiii'),     # entity painting
+        0x1a: ('iiiih',),               # experience orb
+        0x1b: ('ffffbb',),              # stance update
+        0x1c: ('ihhh',),                # entity velocity
+        0x1d: ('i',),                   # destroy entity
+        0x1e: ('i',),                   # entity
+        0x1f: ('ibbb',),                # entity relative move
+        0x20: ('ibb',),                 # entity look
+        0x21: ('ibbbbb',),              # entity look and relative move
+        0x22: ('iiiibb',),              # entity teleport
+        0x23: ('ib',),                  # entity head look
+        0x26: ('ib',),                  # entity status
+        0x27: ('ii',),                  # attach entity
+        0x28: ('i', META),              # entity metadata
+        0x29: ('ibbh',),                # entity effect
+        0x2a: ('ib',),                  # remove entity effect
+        0x2b: ('fhh',),                 # experience
+        0x32: ('iib',),                 # pre-chunk
+        0x33: ('iibHHii', (BYTES, 5, 1)), # map chunk
+        0x34: ('iihi', (BYTES, 3, 1)),  # multi block change
+        0x35: ('ibibb',),               # block change
+        0x36: ('ihibb',),               # block action
+        0x3c: ('dddfi', (BYTES, 4, 3)), # explosion
+        0x3d: ('iibii',),               # sound/particle effect
+        0x46: ('bb',),                  # new/invalid state
+        0x47: ('ibiii',),               # thunderbolt
+        0x64: ('bb', STR16, 'b'),       # open window
+        0x65: ('b',),                   # close window
+        0x66: ('bhbhb', SLOT),          # window click
+        0x67: ('bh', SLOT),             # set slot
+        0x68: ('bh', (SLOTS, 1)),       # window items
+        0x69: ('bhh',),                 # update window property
+        0x6a: ('bhb',),                 # confirm transaction
+        0x6b: ('h', SLOT),              # creative inventory action
+        0x6c: ('bb',),                  # enchant item
+        0x82: ('ihi', STR16, STR16, STR16, STR16), # update sign
+        0x83: ('hhB', (BYTES, 2, 1)),   # item data
+        0x84: ('ihibiii',),             # update tile entity
+        0xc8: ('ib',),                  # increment statistic
+        0xc9: (STR16, 'bh'),            # player list item
+        0xca: ('bbbb',),                # player abilities
+        0xfa: (STR16, 'h', (BYTES, 1, 1)), # plugin message
+        0xfe: (),                       # server list ping
+        0xff: (STR16,),                 # disconnect/kick
+        }
+
+    # filled by compile():
+    #   DISPATCH: packet id -> operations.
+    #   PACKET_LENGTH: packet id -> payload size (for fixed-size packets only).
+    DISPATCH = None
+    PACKET_LENGTH = None
     
+    @classmethod
+    def compile(klass):
+        klass.DISPATCH = {}
+        klass.PACKET_LENGTH = {}
+        for (c,fields) in klass.PACKETS.iteritems():
+            ops = compile_packet(fields)
+            klass.DISPATCH[c] = ops
+            if not ops:
+                klass.PACKET_LENGTH[c] = 0
+            elif len(ops) == 1 and ops[0][0] is None:
+                klass.PACKET_LENGTH[c] = ops[0][1].size
+        return
+
+    # packet ids that are decoded and passed to the _packet_XX handlers.
+    # other packets are skipped by their computed length.
+    SUBSCRIBE = ()
+
     def __init__(self, safemode=False):
         self.safemode = safemode
-        self._stack = [(self._main,None)]
+        self.subscribed = set(self.SUBSCRIBE)
+        self._update_handlers()
+        # input buffer: unparsed bytes are kept here and read by offset.
+        self._buf = bytearray()
+        # the buffer size needed before the next packet can be decoded.
+        self._need = 0
         self._pos = 0
         self._active = True
+        # whether the errors go into the metrics.
+        self.count_errors = True
+        # packet id -> [count, bytes, total time, max time].
+        self.stats = None
+        if self.collect_stats:
+            self.stats = {}
+        return
+
+    def subscribe(self, *ids):
+        self.subscribed.update(ids)
+        self._update_handlers()
+        return
+
+    def unsubscribe(self, *ids):
+        self.subscribed.difference_update(ids)
+        self._update_handlers()
+        return
+
+    def _update_handlers(self):
+        self._handlers = {}
+        for c in self.subscribed:
+            handler = getattr(self, '_packet_%02x' % c, None)
+            if handler is not None:
+                self._handlers[c] = handler
+        # fixed-size packets that nobody handles can be skipped entirely.
+        self._skips = dict( (c,n) for (c,n) in self.PACKET_LENGTH.iteritems()
+                            if c not in self._handlers )
         return
 
     def feed(self, data):
         if self.debugfp is not None:
-            print >>self.debugfp, 'feed: %r: %r' % (self._pos, self._stack)
+            print >>self.debugfp, 'feed: %r: %r' % (self._pos, len(self._buf))
             self.debugfp.flush()
         if not self._active: return
+        buf = self._buf
+        buf.extend(data)
+        n = len(buf)
+        if n < self._need: return
         i = 0
+        need = 0
+        skips = self._skips
+        stats = self.stats
         try:
-            while i < len(data):
-                (parse,arg) = self._stack[-1]
-                if parse(data[i], arg):
-                    i += 1
-            self._pos += len(data)
+            while i < n:
+                c = buf[i]
+                if self.debugfp is not None:
+                    print >>self.debugfp, 'main: %02x' % c
+                size = skips.get(c)
+                if size is not None:
+                    if n <= i+size:
+                        need = i+size+1
+                        break
+                    i += size+1
+                    if stats is not None:
+                        self._count(c, size+1, 0)
+                    continue
+                try:
+                    ops = self.DISPATCH[c]
+                except KeyError:
+                    raise self.ProtocolError('invalid packet: %r' % c)
+                handler = self._handlers.get(c)
+                if stats is not None:
+                    t0 = time.time()
+                try:
+                    if handler is None:
+                        j = self._measure(buf, i+1, ops)
+                    else:
+                        (j, values) = self._decode(buf, i+1, ops)
+                except self.IncompleteError, e:
+                    (need,) = e.args
+                    break
+                if handler is not None:
+                    handler(*values)
+                if stats is not None:
+                    self._count(c, j-i, time.time()-t0)
+                i = j
         except self.ProtocolError, e:
             print >>self.debugfp, 'protocol error: %r: %r' % (self._pos+i, e)
+            if self.count_errors:
+                metrics.protocol_errors += 1
             if self.safemode:
+                if self.count_errors:
+                    metrics.deactivations += 1
                 self._active = False
             else:
                 raise
+        del buf[:i]
+        self._need = need-i
+        self._pos += i
         return
 
-    def _push(self, func, arg=None):
-        if arg is None:
-            arg = ['']
-        elif isinstance(arg, int):
-            arg = [arg]
-        self._stack.append((func, arg))
+    def close(self):
         return
-    
-    def _pop(self):
-        self._stack.pop()
+
+    # returns the stream position of the first packet not parsed yet,
+    # or -1 if the parser has given up.
+    def tell(self):
+        if not self._active: return -1
+        return self._pos
+
+    def _count(self, c, nbytes, t):
+        try:
+            st = self.stats[c]
+        except KeyError:
+            st = self.stats[c] = [0, 0, 0.0, 0.0]
+        st[0] += 1
+        st[1] += nbytes
+        st[2] += t
+        if st[3] < t:
+            st[3] = t
         return
 
-    def _bytes(self, c, arg):
-        if 0 < arg[0]:
-            arg[0] -= 1
-            return True
-        elif 0 == arg[0]:
-            self._pop()
-            return False
-        else:
-            raise self.ProtocolError('invalid bytes: %r' % arg[0])
-    
-    def _str8(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 2:
-            self._pop()
-            self._push(self._bytes, toshort(arg[0]))
-        return True
+    def dump_stats(self, disp):
+        if self.stats is None: return
+        for (c,(count,nbytes,t,tmax)) in sorted(self.stats.iteritems()):
+            disp('packet 0x%02x: count=%d, bytes=%d, time=%.3fs, max=%.6fs' %
+                 (c, count, nbytes, t, tmax))
+        return
 
-    def _str16(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 2:
-            self._pop()
-            self._push(self._bytes, toshort(arg[0])*2)
-        return True
+    def _decode(self, data, i, ops):
+        values = []
+        for (t,arg) in ops:
+            if t is None:
+                j = i+arg.size
+                if len(data) < j: raise self.IncompleteError(j)
+                values.extend(arg.unpack_from(data, i))
+                i = j
+            elif t == STR16:
+                (s,i) = self._str16(data, i)
+                values.append(s)
+            elif t == SLOT:
+                (slot,i) = self._slotdata(data, i)
+                values.append(slot)
+            elif t == META:
+                (meta,i) = self._metadata(data, i)
+                values.append(meta)
+            elif t == BYTES:
+                (k,m) = arg
+                nbytes = values[k]*m
+                if nbytes < 0:
+                    raise self.ProtocolError('invalid bytes: %r' % nbytes)
+                j = i+nbytes
+                if len(data) < j: raise self.IncompleteError(j)
+                values.append(data[i:j])
+                i = j
+            elif t == SLOTS:
+                slots = []
+                for _ in xrange(values[arg[0]]):
+                    (slot,i) = self._slotdata(data, i)
+                    slots.append(slot)
+                values.append(slots)
+            elif t == IF:
+                (k,st) = arg
+                if 0 < values[k]:
+                    j = i+st.size
+                    if len(data) < j: raise self.IncompleteError(j)
+                    values.extend(st.unpack_from(data, i))
+                    i = j
+        return (i, values)
+
+    def _measure(self, data, i, ops):
+        # same as _decode() but only computes the end of the packet.
+        # only fixed-size values are kept for the array lengths.
+        values = []
+        n = len(data)
+        for (t,arg) in ops:
+            if t is None:
+                j = i+arg.size
+                if n < j: raise self.IncompleteError(j)
+                values.extend(arg.unpack_from(data, i))
+                i = j
+                continue
+            elif t == STR16:
+                i = self._skip_str16(data, i)
+            elif t == SLOT:
+                i = self._skip_slotdata(data, i)
+            elif t == META:
+                i = self._skip_metadata(data, i)
+            elif t == BYTES:
+                (k,m) = arg
+                nbytes = values[k]*m
+                if nbytes < 0:
+                    raise self.ProtocolError('invalid bytes: %r' % nbytes)
+                i += nbytes
+                if n < i: raise self.IncompleteError(i)
+            elif t == SLOTS:
+                for _ in xrange(values[arg[0]]):
+                    i = self._skip_slotdata(data, i)
+            elif t == IF:
+                (k,st) = arg
+                if 0 < values[k]:
+                    i += st.size
+                    if n < i: raise self.IncompleteError(i)
+                continue
+            values.append(None)
+        return i
+
+    def _skip_str16(self, data, i):
+        j = i+2
+        if len(data) < j: raise self.IncompleteError(j)
+        (n,) = SHORT.unpack_from(data, i)
+        if n < 0:
+            raise self.ProtocolError('invalid string: %r' % n)
+        i = j+n*2
+        if len(data) < i: raise self.IncompleteError(i)
+        return i
+
+    def _skip_slotdata(self, data, i):
+        j = i+2
+        if len(data) < j: raise self.IncompleteError(j)
+        (bid,) = SHORT.unpack_from(data, i)
+        if bid < 0: return j
+        i = j+3
+        if bid in self.ENCHANTABLE_ITEMS:
+            j = i+2
+            if len(data) < j: raise self.IncompleteError(j)
+            (n,) = SHORT.unpack_from(data, i)
+            i = j
+            if 0 < n:
+                i += n
+        if len(data) < i: raise self.IncompleteError(i)
+        return i
+
+    def _skip_metadata(self, data, i):
+        while 1:
+            if len(data) <= i: raise self.IncompleteError(i+1)
+            c = data[i]
+            i += 1
+            if c == 0x7f: break
+            try:
+                st = self.METADATA[c >> 5]
+            except KeyError:
+                raise self.ProtocolError('invalid metadata: %r' % c)
+            if st is STR16:
+                i = self._skip_str16(data, i)
+            else:
+                i += st.size
+        return i
+
+    def _str16(self, data, i):
+        j = i+2
+        if len(data) < j: raise self.IncompleteError(j)
+        (n,) = SHORT.unpack_from(data, i)
+        if n < 0:
+            raise self.ProtocolError('invalid string: %r' % n)
+        i = j+n*2
+        if len(data) < i: raise self.IncompleteError(i)
+        return (touni(data[j:i]), i)
+
+    ENCHANTABLE_ITEMS = set([
+        0x103, #Flint and steel
+        0x105, #Bow
+        0x15A, #Fishing rod
+        0x167, #Shears
+
+        #TOOLS
+        #sword, shovel, pickaxe, axe, hoe
+        0x10C, 0x10D, 0x10E, 0x10F, 0x122, #WOOD
+        0x110, 0x111, 0x112, 0x113, 0x123, #STONE
+        0x10B, 0x100, 0x101, 0x102, 0x124, #IRON
+        0x114, 0x115, 0x116, 0x117, 0x125, #DIAMOND
+        0x11B, 0x11C, 0x11D, 0x11E, 0x126, #GOLD
+        
+        #ARMOUR
+        #helmet, chestplate, leggings, boots
+        0x12A, 0x12B, 0x12C, 0x12D, #LEATHER
+        0x12E, 0x12F, 0x130, 0x131, #CHAIN
+        0x132, 0x133, 0x134, 0x135, #IRON
+        0x136, 0x137, 0x138, 0x139, #DIAMOND
+        0x13A, 0x13B, 0x13C, 0x13D  #GOLD
+        ])
+    def _slotdata(self, data, i):
+        # returns (bid, count, damage, extra) or None for an empty slot.
+        j = i+2
+        if len(data) < j: raise self.IncompleteError(j)
+        (bid,) = SHORT.unpack_from(data, i)
+        if bid < 0: return (None, j)
+        i = j+3
+        if len(data) < i: raise self.IncompleteError(i)
+        (count,damage) = SLOTINFO.unpack_from(data, j)
+        extra = None
+        if bid in self.ENCHANTABLE_ITEMS:
+            j = i+2
+            if len(data) < j: raise self.IncompleteError(j)
+            (n,) = SHORT.unpack_from(data, i)
+            i = j
+            if 0 < n:
+                i = j+n
+                if len(data) < i: raise self.IncompleteError(i)
+                extra = data[j:i]
+        return ((bid, count, damage, extra), i)
+
+    METADATA = {
+        0: getstruct('b'),
+        1: getstruct('h'),
+        2: getstruct('i'),
+        3: getstruct('f'),
+        4: STR16,
+        5: getstruct('hbh'),
+        6: getstruct('iii'),
+        }
+    def _metadata(self, data, i):
+        # returns a list of (key, value).
+        meta = []
+        while 1:
+            if len(data) <= i: raise self.IncompleteError(i+1)
+            c = data[i]
+            i += 1
+            if c == 0x7f: break
+            try:
+                st = self.METADATA[c >> 5]
+            except KeyError:
+                raise self.ProtocolError('invalid metadata: %r' % c)
+            if st is STR16:
+                (v,i) = self._str16(data, i)
+            else:
+                j = i+st.size
+                if len(data) < j: raise self.IncompleteError(j)
+                v = st.unpack_from(data, i)
+                if len(v) == 1:
+                    (v,) = v
+                i = j
+            meta.append((c & 0x1f, v))
+        return (meta, i)
+
+    # packet handlers
+    def _packet_01(self, eid, username, wtype, mode, dim, diff, height, nplayers):
+        self._login_info(eid, username)
+        self._server_info(wtype, mode, dim, diff, height)
+        return
+    
+    def _packet_03(self, s):
+        self._chat_text(s)
+        return
+    
+    def _packet_04(self, t):
+        self._time_update(t)
+        return
+    
+    def _packet_06(self, x, y, z):
+        self._player_pos(x, y, z)
+        return
+    
+    def _packet_08(self, hp, food, sat):
+        self._player_health(hp, food, sat)
+        return
+    
+    def _packet_09(self, dim, diff, mode, height, wtype):
+        self._server_info(wtype, mode, dim, diff, height)
+        return
+    
+    def _packet_0b(self, x, y, s, z, ground):
+        self._player_pos(x, y, z)
+        return
+    
+    def _packet_0d(self, x, y, s, z, yaw, pitch, ground):
+        self._player_pos(x, y, z)
+        return
+    
+    def _packet_18(self, eid, t, x, y, z, yaw, pitch, head, meta):
+        self._mob_spawn(eid, t, x/32.0, y/32.0, z/32.0)
+        return
+    
+    def _packet_33(self, x, z, g, b1, b2, nbytes, _, data):
+        self._map_chunk((x,z,g,b1,b2), data)
+        return
 
+    # callbacks
     def _login_info(self, entid, username):
         #print 'login', (entid, username)
         return
@@ -129,567 +631,2261 @@ class MCParser(object):
         #print 'mob', (eid,t,x,y,z)
         return
 
-    def _map_chunk(self, (x,z,g,b1,b2), nbytes):
-        #print 'map', (x,y,g,b1,b2), nbytes
-        self._push(self._bytes, nbytes)
+    def _map_chunk(self, (x,z,g,b1,b2), data):
+        #print 'map', (x,y,g,b1,b2), len(data)
         return
-        
-    def _special_01(self, c, arg): # int
-        arg[0] += c
-        if len(arg[0]) == 4:
-            self._pop()
-            self._push(self._special_01_2, ['', toint(arg[0])])
-        return True
-    def _special_01_2(self, c, arg): # str16
-        arg[0] += c
-        if len(arg[0]) == 2:
-            self._pop()
-            self._push(self._special_01_3, ['', arg[1], toshort(arg[0])*2])
-        return True
-    def _special_01_3(self, c, arg):
-        if len(arg[0]) == arg[2]:
-            self._pop()
-            self._login_info(arg[1], touni(arg[0]))
-            self._push(self._special_01_4)
-            return False
-        arg[0] += c
-        return True
-    def _special_01_4(self, c, arg): # str16
-        arg[0] += c
-        if len(arg[0]) == 2:
-            self._pop()
-            self._push(self._special_01_5, ['', toshort(arg[0])*2])
-        return True
-    def _special_01_5(self, c, arg):
-        if len(arg[0]) == arg[1]:
-            self._pop()
-            self._push(self._special_01_6, ['', touni(arg[0])])
-            return False
-        arg[0] += c
-        return True
-    def _special_01_6(self, c, arg): # (int,int,byte,ubyte,ubyte)
-        arg[0] += c
-        if len(arg[0]) == 11:
-            self._pop()
-            (mode,dim,diff,height,nplayers) = unpack('>iibBB', arg[0])
-            self._server_info(arg[1], mode, dim, diff, height)
-        return True
-    
-    def _special_03(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 2:
-            self._pop()
-            self._push(self._special_03_2, ['', toshort(arg[0])*2])
-        return True
-    def _special_03_2(self, c, arg):
-        if len(arg[0]) == arg[1]:
-            self._pop()
-            self._chat_text(touni(arg[0]))
-            return False
-        arg[0] += c
-        return True
-        
-    def _special_04(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 8:
-            self._pop()
-            self._time_update(tolong(arg[0]))
-        return True
-        
-    def _special_06(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 12:
-            self._pop()
-            (x,y,z) = unpack('>iii', arg[0])
-            self._player_pos(x,y,z)
-        return True
-        
-    def _special_08(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 8:
-            self._pop()
-            (hp,food,sat) = unpack('>hhf', arg[0])
-            self._player_health(hp, food, sat)
-        return True
-        
-    def _special_09(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 8:
-            self._pop()
-            self._push(self._special_09_2, ['', arg[0]])
-        return True
-    def _special_09_2(self, c, arg): # str16
-        arg[0] += c
-        if len(arg[0]) == 2:
-            self._pop()
-            self._push(self._special_09_3, ['', arg[1], toshort(arg[0])*2])
-        return True
-    def _special_09_3(self, c, arg):
-        if len(arg[0]) == arg[2]:
-            self._pop()
-            (dim,diff,mode,height) = unpack('>ibbh', arg[1])
-            self._server_info(touni(arg[0]), mode, dim, diff, height)
-            return False
-        arg[0] += c
-        return True
 
-    def _special_0b(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 33:
-            self._pop()
-            (x,y,s,z,ground) = unpack('>ddddB', arg[0])
-            self._player_pos(x,y,z)
-        return True
-        
-    def _special_0d(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 41:
-            self._pop()
-            (x,y,s,z,yaw,pitch,ground) = unpack('>ddddffB', arg[0])
-            self._player_pos(x,y,z)
-        return True
-        
-    def _special_17(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 4:
-            self._pop()
-            if 0 < toint(arg[0]):
-                self._push(self._bytes, 6)
-        return True
+MCParser.compile()
     
-    def _special_18(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 20:
-            self._pop()
-            (eid,t,x,y,z,yaw,pitch,head) = unpack('>ibiiibbb', arg[0])
-            self._mob_spawn(eid,t,x/32.0,y/32.0,z/32.0)
-        return True
+
+##  Events
+##  (what the loggers record)
+##
+class Event(object):
+    __slots__ = ('t',)
+    def __init__(self, t):
+        self.t = t
+        return
+
+class ServerInfoEvent(Event):
+    __slots__ = ('wtype', 'mode', 'dim', 'diff', 'height')
+    def __init__(self, t, wtype, mode, dim, diff, height):
+        self.t = t
+        (self.wtype, self.mode, self.dim, self.diff, self.height) = (wtype, mode, dim, diff, height)
+        return
+
+class ChatEvent(Event):
+    __slots__ = ('text', 'outgoing')
+    def __init__(self, t, text, outgoing=False):
+        self.t = t
+        (self.text, self.outgoing) = (text, outgoing)
+        return
+
+class TimeEvent(Event):
+    __slots__ = ('ticks',)
+    def __init__(self, t, ticks):
+        self.t = t
+        self.ticks = ticks
+        return
+
+class PositionEvent(Event):
+    __slots__ = ('x', 'y', 'z')
+    def __init__(self, t, x, y, z):
+        self.t = t
+        (self.x, self.y, self.z) = (x, y, z)
+        return
+
+class HealthEvent(Event):
+    __slots__ = ('hp', 'food', 'sat')
+    def __init__(self, t, hp, food, sat):
+        self.t = t
+        (self.hp, self.food, self.sat) = (hp, food, sat)
+        return
+
+class LoginEvent(Event):
+    __slots__ = ('username',)
+    def __init__(self, t, username):
+        self.t = t
+        self.username = username
+        return
+
+class MobSpawnEvent(Event):
+    __slots__ = ('eid', 'mtype', 'x', 'y', 'z')
+    def __init__(self, t, eid, mtype, x, y, z):
+        self.t = t
+        (self.eid, self.mtype, self.x, self.y, self.z) = (eid, mtype, x, y, z)
+        return
+
+
+##  Sink
+##  (receives batches of events)
+##
+class Sink(object):
+
+    def write(self, events):
+        return
+
+    def flush(self):
+        return
+
+
+##  RotatingFile
+##  (a log file whose name is a strftime pattern)
+##
+##  Each write() goes to an O_APPEND descriptor with a single system
+##  call, so that the workers appending to the same file never split
+##  each other's lines. It is not buffered.
+##
+class RotatingFile(object):
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.path = None
+        self._fd = None
+        return
+
+    # t is the time of the data, which chooses the file.
+    def write(self, data, t=None):
+        if t is None:
+            t = time.time()
+        path = time.strftime(self.pattern, time.localtime(t))
+        if path != self.path:
+            # a new day (or whatever the pattern says) begins.
+            self.close()
+            self.path = path
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            print >>sys.stderr, "output:", path
+        while data:
+            # a regular file takes it all unless the disk is full.
+            n = os.write(self._fd, data)
+            data = data[n:]
+        return
+
+    def flush(self):
+        return
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        return
+
+
+##  LogWriter
+##  (batches the log lines of the sessions sharing a file)
+##
+class LogWriter(object):
+
+    FLUSH_SIZE = 65536
+    FLUSH_INTERVAL = 1.0
+
+    # the live writers. flushed together from a timer or at exit.
+    writers = weakref.WeakSet()
+    # the writers shared in a process, by output pattern.
+    shared = {}
+
+    @classmethod
+    def open(klass, pattern, echo=True):
+        try:
+            writer = klass.shared[pattern]
+        except KeyError:
+            writer = klass.shared[pattern] = klass(RotatingFile(pattern), echo=echo)
+        return writer
+
+    def __init__(self, fp, echo=True):
+        self.fp = fp
+        self.echo = echo
+        self._lines = []
+        self._size = 0
+        self._t0 = None
+        # the time of the first event in the batch.
+        self._t = None
+        LogWriter.writers.add(self)
+        return
+
+    def write(self, lines, t=None):
+        if not self._lines:
+            self._t0 = time.time()
+            self._t = t
+        self._lines.extend(lines)
+        self._size += sum( len(line)+1 for line in lines )
+        if self.FLUSH_SIZE <= self._size or self.due():
+            self.flush()
+        return
+
+    def due(self):
+        return (self._lines and self.FLUSH_INTERVAL <= time.time()-self._t0)
+
+    def flush(self):
+        if not self._lines: return
+        data = '\n'.join(self._lines)+'\n'
+        self._lines = []
+        self._size = 0
+        if isinstance(self.fp, RotatingFile):
+            # a batch goes to the file of its events, not of the flush.
+            self.fp.write(data, self._t)
+        else:
+            self.fp.write(data)
+        self.fp.flush()
+        if self.echo:
+            sys.stdout.write(data)
+        return
+
+    @classmethod
+    def flush_all(klass, due=False):
+        for writer in list(klass.writers):
+            if not due or writer.due():
+                writer.flush()
+        return
+
+
+##  TextSink
+##
+class TextSink(Sink):
+
+    def __init__(self, fp, echo=True, writer=None, session=None):
+        self.fp = fp
+        if writer is None:
+            writer = LogWriter(fp, echo=echo)
+        self.writer = writer
+        # sessions sharing a file are told apart by a tag.
+        self.tag = ''
+        if session is not None:
+            self.tag = ' [%s]' % session
+        # the formatted timestamp of the last second.
+        self._sec = None
+        self._stamp = None
+        self._formats = {
+            ServerInfoEvent: self._format_server_info,
+            ChatEvent: self._format_chat,
+            TimeEvent: self._format_time,
+            PositionEvent: self._format_position,
+            HealthEvent: self._format_health,
+            LoginEvent: self._format_login,
+            }
+        return
+
+    def write(self, events):
+        lines = []
+        t = None
+        for ev in events:
+            format = self._formats.get(ev.__class__)
+            # not every event has a line.
+            if format is None: continue
+            s = format(ev)
+            sec = int(ev.t)
+            if sec != self._sec:
+                self._sec = sec
+                self._stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))+self.tag
+            lines.append(self._stamp+' '+s.encode('utf-8'))
+            if t is None:
+                t = ev.t
+        if lines:
+            self.writer.write(lines, t)
+        return
+
+    def flush(self):
+        self.writer.flush()
+        return
+
+    def _format_server_info(self, ev):
+        return (' ### server info: wtype=%r, mode=%d, dim=%d, diff=%d, height=%d' %
+                (ev.wtype, ev.mode, ev.dim, ev.diff, ev.height))
+
+    def _format_chat(self, ev):
+        if ev.outgoing:
+            return '>> '+ev.text
+        return ev.text
+
+    def _format_time(self, ev):
+        (d,x) = divmod(ev.ticks, 24000)
+        h = x/1000
+        return ' === day %d, %d:00' % (d, (h+8)%24)
+
+    def _format_position(self, ev):
+        return ' *** (%d, %d, %d)' % (ev.x, ev.y, ev.z)
+
+    def _format_health(self, ev):
+        return ' +++ hp=%d, food=%d, sat=%.1f' % (ev.hp, ev.food, ev.sat)
+
+    def _format_login(self, ev):
+        return ' @@@ login: '+ev.username
+
+
+##  Column files
+##
+##  A column file is a sequence of blocks, each holding the events
+##  of one table:
+##    (magic, table, nrows, nbytes, tmin, tmax) + zlib(columns)
+##  where each column is (length) + data. A fixed-size column is
+##  an array of big-endian values and a string column is a list
+##  of distinct strings followed by an index for each row.
+##  A reader can skip a block by its time range without inflating it.
+##
+COLUMN_MAGIC = 'MCCOL001'
+COLUMN_BLOCK = Struct('>8sBIIdd')
+COLUMN_LENGTH = Struct('>I')
+STR = 'str'
+
+# (name, event, columns). the columns follow (t, session, player).
+COLUMN_TABLES = (
+    ('login', LoginEvent, ()),
+    ('server', ServerInfoEvent, (('wtype', STR), ('mode', 'i'), ('dim', 'i'),
+                                 ('diff', 'b'), ('height', 'h'))),
+    ('chat', ChatEvent, (('text', STR), ('outgoing', 'B'))),
+    ('time', TimeEvent, (('ticks', 'q'),)),
+    ('pos', PositionEvent, (('x', 'i'), ('y', 'i'), ('z', 'i'))),
+    ('health', HealthEvent, (('hp', 'h'), ('food', 'h'), ('sat', 'f'))),
+    ('mob', MobSpawnEvent, (('eid', 'i'), ('mtype', 'b'),
+                            ('x', 'f'), ('y', 'f'), ('z', 'f'))),
+    )
+COLUMN_COMMON = (('t', 'd'), ('session', 'I'), ('player', STR))
+
+def encode_column(fmt, values):
+    n = len(values)
+    if fmt != STR:
+        return pack('>%d%s' % (n, fmt), *values)
+    index = {}
+    strings = []
+    refs = []
+    for v in values:
+        try:
+            i = index[v]
+        except KeyError:
+            i = index[v] = len(strings)
+            strings.append(v)
+        refs.append(i)
+    data = [ pack('>I', len(strings)) ]
+    for v in strings:
+        v = v.encode('utf-8')
+        data.append(pack('>I', len(v))+v)
+    data.append(pack('>%dI' % n, *refs))
+    return ''.join(data)
+
+def decode_strings(data):
+    (n,) = COLUMN_LENGTH.unpack_from(data, 0)
+    i = 4
+    strings = []
+    for _ in xrange(n):
+        (k,) = COLUMN_LENGTH.unpack_from(data, i)
+        strings.append(data[i+4:i+4+k].decode('utf-8'))
+        i += 4+k
+    return (strings, i)
+
+def decode_column(fmt, data, n):
+    if fmt != STR:
+        return unpack('>%d%s' % (n, fmt), data)
+    (strings, i) = decode_strings(data)
+    return [ strings[j] for j in unpack('>%dI' % n, data[i:]) ]
+
+
+##  ColumnWriter
+##  (buffers the events of a process and writes them in blocks)
+##
+class ColumnWriter(object):
+
+    BLOCK_ROWS = 4096
+    FLUSH_INTERVAL = 60.0
+
+    # the writers shared in a process, by output pattern.
+    shared = {}
+
+    @classmethod
+    def open(klass, pattern):
+        try:
+            writer = klass.shared[pattern]
+        except KeyError:
+            writer = klass.shared[pattern] = klass(RotatingFile(pattern))
+        return writer
+
+    def __init__(self, fp):
+        self.fp = fp
+        self._tables = dict( (event, (tid, [ fmt for (_,fmt) in COLUMN_COMMON+columns ]))
+                             for (tid, (_, event, columns)) in enumerate(COLUMN_TABLES) )
+        self._names = dict( (event, [ name for (name,_) in columns ])
+                            for (_, event, columns) in COLUMN_TABLES )
+        # table id -> list of columns.
+        self._columns = {}
+        self._t0 = None
+        # flushed along with the text logs.
+        LogWriter.writers.add(self)
+        return
+
+    def append(self, ev, session, player):
+        (tid, fmts) = self._tables[ev.__class__]
+        try:
+            columns = self._columns[tid]
+        except KeyError:
+            columns = self._columns[tid] = [ [] for _ in fmts ]
+        if self._t0 is None:
+            self._t0 = time.time()
+        row = [ev.t, session, player]+[ getattr(ev, name) for name in self._names[ev.__class__] ]
+        for (column, v) in zip(columns, row):
+            column.append(v)
+        if self.BLOCK_ROWS <= len(columns[0]):
+            self._write_block(tid)
+        return
+
+    def due(self):
+        return (self._t0 is not None and self.FLUSH_INTERVAL <= time.time()-self._t0)
+
+    def flush(self):
+        for tid in sorted(self._columns):
+            self._write_block(tid)
+        self._t0 = None
+        self.fp.flush()
+        return
+
+    def _write_block(self, tid):
+        columns = self._columns.pop(tid)
+        fmts = [ fmt for (_,fmt) in COLUMN_COMMON+COLUMN_TABLES[tid][2] ]
+        data = []
+        for (fmt, values) in zip(fmts, columns):
+            v = encode_column(fmt, values)
+            data.append(COLUMN_LENGTH.pack(len(v))+v)
+        data = zlib.compress(''.join(data))
+        ts = columns[0]
+        # the header and the data in one write, into the file of the first row.
+        self.fp.write(COLUMN_BLOCK.pack(COLUMN_MAGIC, tid, len(ts), len(data), min(ts), max(ts))+data,
+                      min(ts))
+        return
+
+
+##  ColumnSink
+##  (puts the events of a session into a column file)
+##
+class ColumnSink(Sink):
+
+    def __init__(self, writer, session=0):
+        self.writer = writer
+        self.session = session
+        self.player = u''
+        return
+
+    def write(self, events):
+        for ev in events:
+            if isinstance(ev, LoginEvent):
+                self.player = ev.username
+            self.writer.append(ev, self.session, self.player)
+        return
+
+    # the blocks are written when full or from the timer.
+    def flush(self):
+        return
+
+
+##  ColumnReader
+##
+class ColumnReader(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = file(path, 'rb')
+        return
+
+    def close(self):
+        self._fp.close()
+        return
+
+    @classmethod
+    def columns(klass, table):
+        for (name, _, columns) in COLUMN_TABLES:
+            if name == table:
+                return [ col for (col,_) in COLUMN_COMMON+columns ]
+        raise KeyError(table)
+
+    # yields (table, nrows, tmin, tmax, data) without inflating the data.
+    def blocks(self, start=None, end=None):
+        self._fp.seek(0)
+        while 1:
+            header = self._fp.read(COLUMN_BLOCK.size)
+            if len(header) < COLUMN_BLOCK.size: break
+            (magic, tid, n, nbytes, tmin, tmax) = COLUMN_BLOCK.unpack(header)
+            if magic != COLUMN_MAGIC:
+                raise ValueError('broken column file: %r' % self.path)
+            if ((start is not None and tmax < start) or
+                (end is not None and end <= tmin)):
+                self._fp.seek(nbytes, 1)
+                continue
+            data = self._fp.read(nbytes)
+            if len(data) < nbytes: break
+            yield (COLUMN_TABLES[tid][0], n, tmin, tmax, data)
+        return
+
+    # yields the rows of a table as tuples (cf. columns()).
+    def read(self, table, start=None, end=None, player=None):
+        fmts = None
+        for (name, _, columns) in COLUMN_TABLES:
+            if name == table:
+                fmts = [ fmt for (_,fmt) in COLUMN_COMMON+columns ]
+        if fmts is None: raise KeyError(table)
+        for (name, n, _, _, data) in self.blocks(start, end):
+            if name != table: continue
+            data = zlib.decompress(data)
+            parts = []
+            i = 0
+            while i < len(data):
+                (k,) = COLUMN_LENGTH.unpack_from(data, i)
+                parts.append(data[i+4:i+4+k])
+                i += 4+k
+            # the player column tells if the block is of any use.
+            if player is not None and player not in decode_strings(parts[2])[0]: continue
+            rows = zip(*[ decode_column(fmt, part, n) for (fmt, part) in zip(fmts, parts) ])
+            for row in rows:
+                if start is not None and row[0] < start: continue
+                if end is not None and end <= row[0]: continue
+                if player is not None and row[2] != player: continue
+                yield row
+        return
+
+
+##  PositionDecimator
+##  (thins out the player positions)
+##
+##  A position is taken when INTERVAL seconds have passed or the player
+##  has moved DISTANCE blocks since the last one. With a tolerance,
+##  the taken positions are further simplified in windows of WINDOW
+##  points, dropping the ones that are within the tolerance of the path.
+##  A window is cut short when its first point is DELAY seconds old,
+##  so a held position comes out at most that late in the log.
+##
+class PositionDecimator(object):
+
+    INTERVAL = 60
+    DISTANCE = 50
+    WINDOW = 32
+    DELAY = 30
+
+    def __init__(self, interval=INTERVAL, distance=DISTANCE, tolerance=0, window=WINDOW,
+                 delay=DELAY):
+        self.interval = interval
+        self.distance = distance
+        self.tolerance = tolerance
+        self.window = window
+        self.delay = delay
+        self._next = None
+        self._last = None
+        # the last position passed on and the ones waiting for simplification.
+        self._anchor = None
+        self._points = []
+        return
+
+    # returns the (t, p) to be logged.
+    def feed(self, t, p):
+        late = ()
+        if self._points and self.delay <= t-self._points[0][0]:
+            late = self.flush()
+        if (self._last is not None and t < self._next and
+            dist(p, self._last) < self.distance): return late
+        self._next = t+self.interval
+        self._last = p
+        if not self.tolerance:
+            return ((t, p),)
+        self._points.append((t, p))
+        if len(self._points) < self.window: return late
+        return list(late)+self.flush()
+
+    def flush(self):
+        if not self._points: return ()
+        points = self._points
+        if self._anchor is not None:
+            points = [self._anchor]+points
+        keep = simplify([ p for (_,p) in points ], self.tolerance)
+        if self._anchor is not None:
+            keep = keep[1:]
+        self._anchor = points[-1]
+        self._points = []
+        return [ points[i] for i in keep ]
+
+
+##  MCLogger
+##
+class MCLogger(MCParser):
     
-    def _special_33(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 21:
-            self._pop()
-            (x,z,g,b1,b2,nbytes,_) = unpack('>iibHHii', arg[0])
-            self._map_chunk((x,z,g,b1,b2), nbytes)
-        return True
+    def __init__(self, fp, safemode=False, sinks=None, decimator=None):
+        MCParser.__init__(self, safemode=safemode)
+        self.fp = fp
+        if sinks is None:
+            sinks = [TextSink(fp)]
+        self.sinks = sinks
+        if decimator is None:
+            decimator = PositionDecimator()
+        self.decimator = decimator
+        # returns the current time. replaced when parsing a capture.
+        self.clock = time.time
+        # events before this time are dropped.
+        self.start = None
+        self._events = []
+        return
+
+    def feed(self, data):
+        MCParser.feed(self, data)
+        if self._events:
+            self._write_events()
+        return
+
+    def close(self):
+        MCParser.close(self)
+        # the positions held back for simplification.
+        for (t, p) in self.decimator.flush():
+            self._events.append(PositionEvent(t, *p))
+        if self._events:
+            self._write_events()
+        for sink in self.sinks:
+            sink.flush()
+        return
+
+    def _write_events(self):
+        events = self._events
+        self._events = []
+        if self.start is not None:
+            events = [ ev for ev in events if self.start <= ev.t ]
+            if not events: return
+        for sink in self.sinks:
+            sink.write(events)
+        return
+
+    def _emit(self, klass, *args):
+        self._events.append(klass(self.clock(), *args))
+        return
+
+    def _emit_position(self, x, y, z):
+        for (t, p) in self.decimator.feed(self.clock(), (int(x), int(y), int(z))):
+            self._events.append(PositionEvent(t, *p))
+        return
+
+
+##  MCServerLogger
+##
+class MCServerLogger(MCLogger):
+
+    SUBSCRIBE = (0x01, 0x03, 0x04, 0x06, 0x08, 0x09, 0x0b, 0x0d, 0x33)
+
+    def __init__(self, fp, safemode=False,
+                 chat_text=True, time_update=True,
+                 player_pos=True, player_health=True,
+                 map_chunk_path=None, map_dimension=None,
+                 mob_spawn=False, sinks=None, decimator=None):
+        MCLogger.__init__(self, fp, safemode=safemode, sinks=sinks, decimator=decimator)
+        self.rec_chat_text = chat_text
+        self.rec_time_update = time_update
+        self.rec_player_pos = player_pos
+        self.rec_player_health = player_health
+        self.map_chunk_path = map_chunk_path
+        self.map_dimension = map_dimension
+        self._dim = None
+        self._h = -1
+        if not chat_text:
+            self.unsubscribe(0x03)
+        if not time_update:
+            self.unsubscribe(0x04)
+        if not player_pos:
+            self.unsubscribe(0x06, 0x0b, 0x0d)
+        if not player_health:
+            self.unsubscribe(0x08)
+        if map_chunk_path is None or map_dimension is None:
+            self.unsubscribe(0x33)
+        if mob_spawn:
+            self.subscribe(0x18)
+        return
+    
+    def _server_info(self, wtype, mode, dim, diff, height):
+        self._emit(ServerInfoEvent, wtype, mode, dim, diff, height)
+        self._dim = dim
+        return
+
+    def _chat_text(self, s):
+        if not self.rec_chat_text: return
+        s = re.sub(ur'\xa7.', '', s)
+        self._emit(ChatEvent, s)
+        return
+
+    def _time_update(self, t):
+        if not self.rec_time_update: return
+        h = (t % 24000)/1000
+        if self._h != h:
+            self._h = h
+            self._emit(TimeEvent, t)
+        return
+
+    def _player_pos(self, x, y, z):
+        if not self.rec_player_pos: return
+        self._emit_position(x, y, z)
+        return
+    
+    def _mob_spawn(self, eid, t, x, y, z):
+        self._emit(MobSpawnEvent, eid, t, x, y, z)
+        return
+
+    def _player_health(self, hp, food, sat):
+        if not self.rec_player_health: return
+        self._emit(HealthEvent, hp, food, sat)
+        return
+
+    def _map_chunk(self, (x,z,g,b1,b2), data):
+        if (self.map_chunk_path is not None and
+            (self.map_dimension is not None and self.map_dimension == self._dim)):
+            name = 'r.%d.%d.maplog' % (x>>9, z>>9)
+            path = os.path.join(self.map_chunk_path, name)
+            fp = file(path, 'ab')
+            fp.write(pack('>iibHH', x,z,g,b1,b2))
+            fp.write(pack('>i', len(data)))
+            fp.write(data)
+            fp.close()
+        return
+    
+
+##  MCClientLogger
+##
+class MCClientLogger(MCLogger):
+
+    SUBSCRIBE = (0x01, 0x03, 0x0b, 0x0d)
+
+    def __init__(self, fp, safemode=False,
+                 chat_text=True, player_pos=True,
+                 sinks=None, decimator=None):
+        MCLogger.__init__(self, fp, safemode=safemode, sinks=sinks, decimator=decimator)
+        self.rec_chat_text = chat_text
+        self.rec_player_pos = player_pos
+        if not chat_text:
+            self.unsubscribe(0x03)
+        if not player_pos:
+            self.unsubscribe(0x0b, 0x0d)
+        return
+
+    def _login_info(self, entid, username):
+        self._emit(LoginEvent, username)
+        return
+
+    def _chat_text(self, s):
+        if not self.rec_chat_text: return
+        s = re.sub(ur'\xa7.', '', s)
+        self._emit(ChatEvent, s, True)
+        return
+
+    def _player_pos(self, x, y, z):
+        if not self.rec_player_pos: return
+        self._emit_position(x, y, z)
+        return
+
+
+##  RingBuffer
+##  (a shared memory byte queue from the proxy to a parser process)
+##
+class RingBuffer(object):
+
+    # session, kind, length and the time the proxy got the data.
+    HEADER = Struct('>iBId')
+
+    def __init__(self, size):
+        self.size = size
+        self._buf = multiprocessing.RawArray('c', size)
+        self._addr = ctypes.addressof(self._buf)
+        # total number of bytes written/read so far.
+        self._head = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        self._tail = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        self._event = multiprocessing.Event()
+        return
+
+    # called by the proxy. returns False if there's no room.
+    def put(self, session, kind, data='', t=0):
+        n = self.HEADER.size+len(data)
+        head = self._head.value
+        if self.size < head+n-self._tail.value: return False
+        self._write(head, self.HEADER.pack(session, kind, len(data), t))
+        self._write(head+self.HEADER.size, data)
+        self._head.value = head+n
+        self._event.set()
+        return True
+
+    # called by the parser process. returns a list of (session, kind, t, data).
+    def get(self, timeout=None):
+        self._event.clear()
+        head = self._head.value
+        tail = self._tail.value
+        if head == tail:
+            self._event.wait(timeout)
+            return []
+        records = []
+        while tail < head:
+            (session, kind, n, t) = self.HEADER.unpack(self._read(tail, self.HEADER.size))
+            tail += self.HEADER.size
+            records.append((session, kind, t, self._read(tail, n)))
+            tail += n
+        self._tail.value = tail
+        return records
+
+    def _write(self, pos, data):
+        i = pos % self.size
+        n = min(len(data), self.size-i)
+        ctypes.memmove(self._addr+i, data, n)
+        if n < len(data):
+            ctypes.memmove(self._addr, data[n:], len(data)-n)
+        return
+
+    def _read(self, pos, n):
+        i = pos % self.size
+        k = min(n, self.size-i)
+        data = ctypes.string_at(self._addr+i, k)
+        if k < n:
+            data += ctypes.string_at(self._addr, n-k)
+        return data
+
+
+##  RingFeeder
+##  (takes place of a parser in a proxy and passes the data to a ring)
+##
+class RingFeeder(object):
+
+    CLOSE = 2
+
+    def __init__(self, ring, session, kind):
+        self.ring = ring
+        self.session = session
+        self.kind = kind
+        self.lost = False
+        return
+
+    def feed(self, data):
+        if self.lost: return
+        if not self.ring.put(self.session, self.kind, data, time.time()):
+            # the stream cannot be parsed after a gap, so we give up.
+            print >>sys.stderr, 'SESSION %s: parser is lagging, stopped logging' % self.session
+            self.lost = True
+        return
+
+    def close(self):
+        self.ring.put(self.session, self.kind | self.CLOSE)
+        return
+
+    def dump_stats(self, disp):
+        return
+
+
+##  ParserProcess
+##
+class ParserProcess(object):
+
+    # tells the process to write out everything and quit.
+    STOP = 4
+
+    def __init__(self, ring, create_loggers):
+        self.ring = ring
+        self.create_loggers = create_loggers
+        self._process = None
+        return
+
+    def start(self):
+        self._process = multiprocessing.Process(target=self.run)
+        self._process.daemon = True
+        self._process.start()
+        return
+
+    # called by the proxy at exit. waits until the ring is drained.
+    def stop(self, timeout=10):
+        deadline = time.time()+timeout
+        while not self.ring.put(0, self.STOP):
+            if deadline < time.time(): break
+            time.sleep(0.01)
+        self._process.join(max(0, deadline-time.time()))
+        return
+
+    def run(self):
+        sessions = {}
+        # the events get the time the proxy received the data.
+        now = [0]
+        clock = lambda: now[0]
+        def dump_stats(signum, frame):
+            for (session,(clientloggers,serverloggers)) in sorted(sessions.iteritems()):
+                disp = lambda s: sys.stderr.write('PARSER %s: %s\n' % (session, s))
+                for proc in clientloggers+serverloggers:
+                    proc.dump_stats(disp)
+            return
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, dump_stats)
+        # the proxy stops us at exit. a ^C is left to the proxy
+        # so that the ring is drained.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # the proxy terminates us if we don't stop in time.
+        # write out the buffers first.
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, terminate)
+        ppid = os.getppid()
+        stopped = False
+        try:
+            # quit when the proxy is gone.
+            while not stopped and os.getppid() == ppid:
+                LogWriter.flush_all(due=True)
+                for (session, kind, t, data) in self.ring.get(LogWriter.FLUSH_INTERVAL):
+                    if kind == self.STOP:
+                        stopped = True
+                        break
+                    if session not in sessions:
+                        sessions[session] = self.create_loggers(session)
+                        for proc in sessions[session][0]+sessions[session][1]:
+                            proc.clock = clock
+                    now[0] = t
+                    procs = sessions[session][kind & 1]
+                    if kind & RingFeeder.CLOSE:
+                        for proc in procs:
+                            proc.close()
+                        del procs[:]
+                        if not (sessions[session][0] or sessions[session][1]):
+                            del sessions[session]
+                    else:
+                        for proc in procs:
+                            proc.feed(data)
+            # the sessions still open hold events back.
+            for (clientloggers,serverloggers) in sessions.itervalues():
+                for proc in clientloggers+serverloggers:
+                    proc.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            LogWriter.flush_all()
+        return
+
+
+##  Capture files
+##
+##  A capture file starts with MAGIC and is followed by records:
+##    (session, direction, timestamp, length) + data
+##  Its index file (.idx) has an entry for each record:
+##    (offset, session, direction, timestamp, position, boundary)
+##  where position is the stream position of the record data and
+##  boundary is the stream position of a packet start at or before it.
+##
+LOCAL2REMOTE = 0
+REMOTE2LOCAL = 1
+
+CAPTURE_MAGIC = 'MCCAP001'
+CAPTURE_RECORD = Struct('>IBdI')
+CAPTURE_INDEX = Struct('>QIBdQq')
+
+def is_capture(path):
+    fp = file(path, 'rb')
+    magic = fp.read(len(CAPTURE_MAGIC))
+    fp.close()
+    return magic == CAPTURE_MAGIC
+
+
+##  CaptureWriter
+##
+class CaptureWriter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = file(path, 'wb')
+        self._fp.write(CAPTURE_MAGIC)
+        self._index = file(path+'.idx', 'wb')
+        self._offset = len(CAPTURE_MAGIC)
+        self._t = 0
+        # (session, direction) -> [position, parser]
+        self._streams = {}
+        return
+
+    def write(self, session, direction, data):
+        key = (session, direction)
+        try:
+            stream = self._streams[key]
+        except KeyError:
+            # this parser only tracks the packet boundaries.
+            parser = MCParser(safemode=True)
+            parser.debugfp = None
+            # the loggers count the errors of the same stream.
+            parser.count_errors = False
+            stream = self._streams[key] = [0, parser]
+        (pos, parser) = stream
+        # timestamps never go back even if the clock does.
+        self._t = max(self._t, time.time())
+        self._index.write(CAPTURE_INDEX.pack(self._offset, session, direction,
+                                             self._t, pos, parser.tell()))
+        self._fp.write(CAPTURE_RECORD.pack(session, direction, self._t, len(data)))
+        self._fp.write(data)
+        self._offset += CAPTURE_RECORD.size+len(data)
+        stream[0] = pos+len(data)
+        parser.feed(data)
+        return
+
+    def close_stream(self, session):
+        for direction in (LOCAL2REMOTE, REMOTE2LOCAL):
+            self._streams.pop((session, direction), None)
+        self._fp.flush()
+        self._index.flush()
+        return
+
+    def close(self):
+        self._fp.close()
+        self._index.close()
+        return
+
+
+##  CaptureReader
+##
+class CaptureReader(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = file(path, 'rb')
+        if self._fp.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError('not a capture: %r' % path)
+        self._index = None
+        try:
+            fp = file(path+'.idx', 'rb')
+            data = fp.read()
+            fp.close()
+            n = CAPTURE_INDEX.size
+            self._index = [ CAPTURE_INDEX.unpack_from(data, i)
+                            for i in xrange(0, len(data)-n+1, n) ]
+        except IOError:
+            pass
+        return
+
+    def close(self):
+        self._fp.close()
+        return
+
+    def _read_record(self):
+        header = self._fp.read(CAPTURE_RECORD.size)
+        if len(header) < CAPTURE_RECORD.size: return None
+        (session, direction, t, n) = CAPTURE_RECORD.unpack(header)
+        data = self._fp.read(n)
+        if len(data) < n: return None
+        return (session, direction, t, data)
+
+    # yields (session, direction, timestamp, data) between start and end.
+    # with an index, each stream is resumed from a packet boundary.
+    def read(self, start=None, end=None):
+        if start is None or self._index is None:
+            self._fp.seek(len(CAPTURE_MAGIC))
+            while 1:
+                rec = self._read_record()
+                if rec is None: break
+                t = rec[2]
+                if end is not None and end <= t: break
+                if start is not None and t < start: continue
+                yield rec
+            return
+        entries = self._index
+        i0 = bisect.bisect_left([ e[3] for e in entries ], start)
+        # find the first record of each stream after the start
+        # and the record that contains its boundary.
+        resume = {}
+        first = len(entries)
+        for i in xrange(i0, len(entries)):
+            (_, session, direction, _, _, boundary) = entries[i]
+            key = (session, direction)
+            if key in resume: continue
+            if boundary < 0:
+                resume[key] = None
+                continue
+            j = i
+            while boundary < entries[j][4]:
+                j -= 1
+                while entries[j][1:3] != key:
+                    j -= 1
+            resume[key] = boundary
+            first = min(first, j)
+        for (offset, session, direction, t, pos, _) in entries[first:]:
+            if end is not None and end <= t: break
+            boundary = resume.get((session, direction))
+            if boundary is None: continue
+            self._fp.seek(offset)
+            rec = self._read_record()
+            if rec is None: break
+            data = rec[3]
+            if pos+len(data) <= boundary: continue
+            if pos < boundary:
+                data = data[boundary-pos:]
+            yield (session, direction, t, data)
+        return
+
+
+##  Event loop
+##
+##  Sockets stay registered with the poller for their whole life
+##  and a dispatcher only tells the loop when its interest changes,
+##  so an iteration costs nothing for idle connections.
+##
+READ = 0x001                    # EPOLLIN/POLLIN
+WRITE = 0x004                   # EPOLLOUT/POLLOUT
+ERROR = 0x008 | 0x010           # EPOLLERR|EPOLLHUP/POLLERR|POLLHUP
+
+WOULDBLOCK = (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINPROGRESS, errno.EALREADY)
+DISCONNECTED = (errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
+                errno.ECONNABORTED, errno.EPIPE, errno.EBADF)
+
+
+##  EpollPoller
+##
+class EpollPoller(object):
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        return
+
+    def register(self, fd, mask):
+        self._epoll.register(fd, mask)
+        return
+
+    def modify(self, fd, mask):
+        self._epoll.modify(fd, mask)
+        return
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+        return
+
+    # the timeout is rounded up so that timers are not missed.
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout += 0.001
+        return self._epoll.poll(timeout)
+
+
+##  PollPoller
+##
+class PollPoller(object):
+
+    def __init__(self):
+        self._poll = select.poll()
+        return
+
+    def register(self, fd, mask):
+        self._poll.register(fd, mask)
+        return
+
+    def modify(self, fd, mask):
+        self._poll.modify(fd, mask)
+        return
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+        return
+
+    def poll(self, timeout):
+        if timeout is not None:
+            timeout = int(timeout*1000)+1
+        return self._poll.poll(timeout)
+
+
+##  SelectPoller
+##
+class SelectPoller(object):
+
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+        return
+
+    def register(self, fd, mask):
+        self.modify(fd, mask)
+        return
+
+    def modify(self, fd, mask):
+        if mask & READ:
+            self._readers.add(fd)
+        else:
+            self._readers.discard(fd)
+        if mask & WRITE:
+            self._writers.add(fd)
+        else:
+            self._writers.discard(fd)
+        return
+
+    def unregister(self, fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+        return
+
+    def poll(self, timeout):
+        (r,w,x) = select.select(self._readers, self._writers, self._writers, timeout)
+        events = {}
+        for fd in r:
+            events[fd] = events.get(fd, 0) | READ
+        for fd in w:
+            events[fd] = events.get(fd, 0) | WRITE
+        for fd in x:
+            events[fd] = events.get(fd, 0) | ERROR
+        return events.items()
+
+
+##  Timer
+##
+class Timer(object):
+
+    def __init__(self, t, func, args):
+        self.t = t
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        return
+
+    def cancel(self):
+        self.cancelled = True
+        return
+
+
+##  Histogram
+##
+class Histogram(object):
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds)+1)
+        self.total = 0.0
+        return
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.total += v
+        return
+
+
+##  EventLoop
+##
+class EventLoop(object):
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = EpollPoller()
+        elif hasattr(select, 'poll'):
+            self._poller = PollPoller()
+        else:
+            self._poller = SelectPoller()
+        # fd -> dispatcher
+        self._dispatchers = {}
+        # heap of (time, seq, timer)
+        self._timers = []
+        self._seq = 0
+        self._running = False
+        # calls from other threads.
+        self._pending = []
+        self._lock = threading.Lock()
+        self._waker = Waker(self)
+        # time spent on each iteration, not counting the wait.
+        self.latency = Histogram((0.0001, 0.001, 0.01, 0.1, 1.0))
+        return
+
+    def add(self, disp, mask):
+        self._dispatchers[disp.fileno] = disp
+        self._poller.register(disp.fileno, mask)
+        return
+
+    def modify(self, disp, mask):
+        self._poller.modify(disp.fileno, mask)
+        return
+
+    def remove(self, disp):
+        if self._dispatchers.get(disp.fileno) is disp:
+            del self._dispatchers[disp.fileno]
+            self._poller.unregister(disp.fileno)
+        return
+
+    def dispatchers(self):
+        return self._dispatchers.values()
+
+    # calls func(*args) after delay seconds. returns a Timer.
+    def call_later(self, delay, func, *args):
+        return self.call_at(time.time()+delay, func, *args)
+
+    def call_at(self, t, func, *args):
+        timer = Timer(t, func, args)
+        self._seq += 1
+        heapq.heappush(self._timers, (t, self._seq, timer))
+        return timer
+
+    # can be called from another thread.
+    def call_soon_threadsafe(self, func, *args):
+        self._lock.acquire()
+        try:
+            self._pending.append((func, args))
+        finally:
+            self._lock.release()
+        self._waker.wake()
+        return
+
+    def _run_pending(self):
+        self._lock.acquire()
+        try:
+            (pending, self._pending) = (self._pending, [])
+        finally:
+            self._lock.release()
+        for (func, args) in pending:
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+        return
+
+    def stop(self):
+        self._running = False
+        return
+
+    def run(self):
+        self._running = True
+        while self._running and (self._dispatchers or self._timers):
+            timeout = None
+            if self._timers:
+                timeout = max(0, self._timers[0][0]-time.time())
+            try:
+                events = self._poller.poll(timeout)
+            except (select.error, IOError, OSError), e:
+                # interrupted by a signal.
+                if e.args[0] == errno.EINTR: continue
+                raise
+            t0 = time.time()
+            for (fd, mask) in events:
+                disp = self._dispatchers.get(fd)
+                if disp is None: continue
+                try:
+                    disp.handle_event(mask)
+                except Exception:
+                    disp.handle_error()
+            self._run_timers()
+            self.latency.observe(time.time()-t0)
+        return
+
+    def _run_timers(self):
+        timers = self._timers
+        now = time.time()
+        while timers and timers[0][0] <= now:
+            (_,_,timer) = heapq.heappop(timers)
+            if timer.cancelled: continue
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                traceback.print_exc()
+        return
+
+_loop = None
+def get_event_loop():
+    global _loop
+    if _loop is None:
+        _loop = EventLoop()
+    return _loop
+
+
+##  Dispatcher
+##  (a non-blocking socket registered to an EventLoop)
+##
+class Dispatcher(object):
+
+    def __init__(self, sock=None, loop=None):
+        self.loop = loop or get_event_loop()
+        self.socket = None
+        self.fileno = None
+        self.accepting = False
+        self.connecting = False
+        self.connected = False
+        self._mask = 0
+        if sock is not None:
+            self.connected = True
+            self.set_socket(sock)
+        return
+
+    def create_socket(self, family, type):
+        self.set_socket(socket.socket(family, type))
+        return
+
+    def set_socket(self, sock):
+        sock.setblocking(0)
+        self.socket = sock
+        self.fileno = sock.fileno()
+        self._mask = self._interest()
+        self.loop.add(self, self._mask)
+        return
+
+    def _interest(self):
+        if self.connecting: return WRITE
+        mask = 0
+        if self.readable():
+            mask |= READ
+        if self.writable():
+            mask |= WRITE
+        return mask
+
+    # must be called when readable() or writable() may have changed.
+    def update(self):
+        if self.socket is None: return
+        mask = self._interest()
+        if mask != self._mask:
+            self._mask = mask
+            self.loop.modify(self, mask)
+        return
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def set_reuse_addr(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                               self.socket.getsockopt(socket.SOL_SOCKET,
+                                                      socket.SO_REUSEADDR) | 1)
+        return
+
+    def bind(self, addr):
+        self.socket.bind(addr)
+        return
+
+    def listen(self, backlog):
+        self.accepting = True
+        self.socket.listen(backlog)
+        self.update()
+        return
+
+    # returns (conn, addr) or None.
+    def accept(self):
+        try:
+            return self.socket.accept()
+        except socket.error, e:
+            if e.args[0] in WOULDBLOCK or e.args[0] == errno.ECONNABORTED: return None
+            raise
+
+    def connect(self, addr):
+        err = self.socket.connect_ex(addr)
+        if err in WOULDBLOCK:
+            self.connecting = True
+            self.update()
+        elif err == 0:
+            self._handle_connected()
+        else:
+            raise socket.error(err, os.strerror(err))
+        return
+
+    def send(self, data):
+        try:
+            return self.socket.send(data)
+        except socket.error, e:
+            if e.args[0] in WOULDBLOCK: return 0
+            if e.args[0] in DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+
+    # returns '' and closes the dispatcher when the peer is gone.
+    def recv(self, bufsize):
+        try:
+            data = self.socket.recv(bufsize)
+        except socket.error, e:
+            if e.args[0] in WOULDBLOCK: return ''
+            if e.args[0] in DISCONNECTED:
+                self.handle_close()
+                return ''
+            raise
+        if not data:
+            self.handle_close()
+        return data
+
+    def close(self):
+        if self.socket is None: return
+        self.loop.remove(self)
+        self.socket.close()
+        self.socket = None
+        self.accepting = self.connecting = self.connected = False
+        return
+
+    def _handle_connected(self):
+        self.connecting = False
+        self.connected = True
+        self.update()
+        self.handle_connect()
+        return
+
+    def handle_event(self, mask):
+        if self.connecting:
+            err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            self._handle_connected()
+            return
+        if mask & READ:
+            if self.accepting:
+                self.handle_accept()
+            else:
+                self.handle_read()
+        if mask & WRITE and self.socket is not None:
+            self.handle_write()
+        if mask & ERROR and not (mask & READ) and self.socket is not None:
+            self.handle_close()
+        self.update()
+        return
+
+    def handle_error(self):
+        self.log_error()
+        if self.socket is not None:
+            self.handle_close()
+        return
+
+    def log_error(self):
+        (t,v,tb) = sys.exc_info()
+        if isinstance(v, socket.error):
+            print >>sys.stderr, 'error: %s' % v
+        else:
+            traceback.print_exc()
+        return
+
+    def handle_accept(self):
+        return
+
+    def handle_connect(self):
+        return
+
+    def handle_read(self):
+        return
+
+    def handle_write(self):
+        return
+
+    def handle_close(self):
+        self.close()
+        return
+
+
+# returns a pair of connected sockets.
+def socketpair():
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    # windows does not have socketpair(), so it is made over the loopback.
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sock1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock1.connect(listener.getsockname())
+        (sock2, _) = listener.accept()
+    finally:
+        listener.close()
+    return (sock1, sock2)
+
+
+##  Waker
+##  (wakes up the loop from another thread)
+##
+class Waker(Dispatcher):
+
+    def __init__(self, loop):
+        (sock, self._sender) = socketpair()
+        self._sender.setblocking(0)
+        Dispatcher.__init__(self, sock, loop=loop)
+        return
+
+    def wake(self):
+        try:
+            self._sender.send('x')
+        except socket.error:
+            # the pipe is full, so the loop will wake up anyway.
+            pass
+        return
+
+    def handle_read(self):
+        self.recv(4096)
+        self.loop._run_pending()
+        return
+
+
+##  SendQueue
+##  (outgoing data as a list of strings. a partial send only moves
+##   an offset into the first string instead of copying the rest.)
+##
+class SendQueue(object):
+
+    # small strings are joined up to this size so that one send covers them.
+    COALESCE = 65536
+
+    def __init__(self):
+        self._chunks = collections.deque()
+        self._offset = 0
+        self._size = 0
+        return
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+        return
+
+    # returns the data to be sent next.
+    def peek(self):
+        chunks = self._chunks
+        if self._offset:
+            return buffer(chunks[0], self._offset)
+        if 1 < len(chunks) and len(chunks[0]) < self.COALESCE:
+            parts = []
+            n = 0
+            while chunks and n+len(chunks[0]) <= self.COALESCE:
+                data = chunks.popleft()
+                parts.append(data)
+                n += len(data)
+            chunks.appendleft(''.join(parts))
+        return chunks[0]
+
+    # removes n bytes that have been sent.
+    def consume(self, n):
+        self._size -= n
+        n += self._offset
+        chunks = self._chunks
+        while chunks and len(chunks[0]) <= n:
+            n -= len(chunks.popleft())
+        self._offset = n
+        return
+
+
+##  DelayQueue
+##  (holds data for a while and passes it on from a loop timer)
+##
+class DelayQueue(object):
+
+    def __init__(self, loop, deliver, delay, jitter=0):
+        self.loop = loop
+        self.deliver = deliver
+        # in milliseconds.
+        self.delay = delay
+        self.jitter = jitter
+        # bytes waiting in the queue.
+        self.size = 0
+        self._queue = collections.deque()
+        self._last = 0
+        self._timer = None
+        return
+
+    def put(self, data):
+        t = self.delay
+        if self.jitter:
+            t += random.uniform(-self.jitter, self.jitter)
+        # the data is never reordered.
+        t = max(time.time()+t*.001, self._last)
+        self._last = t
+        self._queue.append((t, data))
+        self.size += len(data)
+        # only the first item in the queue has a timer.
+        if self._timer is None:
+            self._timer = self.loop.call_at(t, self._release)
+        return
+
+    def _release(self):
+        self._timer = None
+        queue = self._queue
+        now = time.time()
+        while queue and queue[0][0] <= now:
+            (_, data) = queue.popleft()
+            self.size -= len(data)
+            self.deliver(data)
+        if queue:
+            self._timer = self.loop.call_at(queue[0][0], self._release)
+        return
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._queue.clear()
+        self.size = 0
+        return
+
+
+##  TokenBucket
+##
+class TokenBucket(object):
+
+    # the burst is at least this large so that a sender can always
+    # wait for a reasonable piece of data.
+    MIN_BURST = 4096
+
+    def __init__(self, rate, burst=None):
+        # bytes per second.
+        self.rate = rate
+        self.burst = max(burst or rate, self.MIN_BURST)
+        self.tokens = float(self.burst)
+        self._t = time.time()
+        return
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens+(now-self._t)*self.rate)
+        self._t = now
+        return
+
+    # returns the seconds until n tokens are available.
+    def wait(self, n):
+        return max(0, (n-self.tokens)/self.rate)
+
+    def take(self, n):
+        self.tokens -= n
+        return
+
+
+##  SharedTokenBucket
+##  (a bucket shared by the worker processes. it must be made
+##   before they are forked.)
+##
+class SharedTokenBucket(TokenBucket):
+
+    def __init__(self, rate, burst=None):
+        # the tokens and the time of the last refill.
+        self._state = multiprocessing.RawArray('d', 2)
+        self._lock = multiprocessing.Lock()
+        TokenBucket.__init__(self, rate, burst=burst)
+        return
+
+    def _get_tokens(self):
+        return self._state[0]
+    def _set_tokens(self, tokens):
+        self._state[0] = tokens
+        return
+    tokens = property(_get_tokens, _set_tokens)
+
+    def _get_t(self):
+        return self._state[1]
+    def _set_t(self, t):
+        self._state[1] = t
+        return
+    _t = property(_get_t, _set_t)
+
+    def refill(self, now):
+        self._lock.acquire()
+        try:
+            # another worker may have refilled it later.
+            if self._t < now:
+                TokenBucket.refill(self, now)
+        finally:
+            self._lock.release()
+        return
+
+    def take(self, n):
+        self._lock.acquire()
+        try:
+            TokenBucket.take(self, n)
+        finally:
+            self._lock.release()
+        return
+
+
+##  Shaper
+##  (limits the data sent in one direction with one or more buckets.
+##   a bucket can be shared by all the sessions.)
+##
+class Shaper(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.blocked = False
+        self._timer = None
+        return
+
+    # sends the queued data through a dispatcher within the limits.
+    # if nothing can be sent, the dispatcher is blocked until
+    # there are enough tokens.
+    def send(self, disp, queue):
+        data = queue.peek()
+        now = time.time()
+        for bucket in self.buckets:
+            bucket.refill(now)
+        k = int(min( bucket.tokens for bucket in self.buckets ))
+        n = min(len(data), TokenBucket.MIN_BURST)
+        if k < n:
+            wait = max( bucket.wait(n) for bucket in self.buckets )
+            self.blocked = True
+            self._timer = disp.loop.call_later(wait, self._resume, disp)
+            return 0
+        if k < len(data):
+            data = buffer(data, 0, k)
+        n = disp.send(data)
+        for bucket in self.buckets:
+            bucket.take(n)
+        queue.consume(n)
+        return n
+
+    def _resume(self, disp):
+        self._timer = None
+        self.blocked = False
+        disp.update()
+        return
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return
+
+    def __str__(self):
+        return ', '.join( '%d/%d' % (bucket.tokens, bucket.burst) for bucket in self.buckets )
+
+
+##  SpliceRelay
+##  (moves data from a socket to another through a pipe within the kernel.
+##   a copy of the data is taken with tee() only when there are parsers.)
+##
+SPLICE_F_MOVE = 0x01
+SPLICE_F_NONBLOCK = 0x02
+
+_libc = None
+def splice_available():
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                libc.splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+                libc.splice.restype = ctypes.c_ssize_t
+                libc.tee.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+                libc.tee.restype = ctypes.c_ssize_t
+                _libc = libc
+            except (OSError, AttributeError):
+                pass
+    return bool(_libc)
+
+# returns the number of bytes moved, or None if it would block.
+def _splice_result(n):
+    if n < 0:
+        err = ctypes.get_errno()
+        if err in WOULDBLOCK: return None
+        raise socket.error(err, os.strerror(err))
+    return n
+
+def splice(fdin, fdout, n):
+    return _splice_result(_libc.splice(fdin, None, fdout, None, n,
+                                       SPLICE_F_MOVE | SPLICE_F_NONBLOCK))
+
+def tee(fdin, fdout, n):
+    return _splice_result(_libc.tee(fdin, fdout, n, SPLICE_F_NONBLOCK))
+
+class SpliceRelay(object):
+
+    # the default capacity of a pipe.
+    PIPE_SIZE = 65536
+
+    def __init__(self, procs):
+        self.procs = procs
+        # bytes in the pipe that are not sent yet.
+        self.pending = 0
+        self._pipe = self._open_pipe()
+        self._tee = None
+        if procs:
+            self._tee = self._open_pipe()
+        return
+
+    def _open_pipe(self):
+        import fcntl
+        (r,w) = os.pipe()
+        for fd in (r,w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        return (r,w)
+
+    # takes data from a socket. returns 0 at EOF.
+    # new data is only taken after the pipe is emptied, so that
+    # tee() copies exactly the new bytes.
+    def fill(self, fd):
+        assert not self.pending
+        n = splice(fd, self._pipe[1], self.PIPE_SIZE)
+        if n:
+            self.pending = n
+            if self._tee is not None:
+                self._copy(n)
+        return n
+
+    def _copy(self, n):
+        (r,w) = self._tee
+        m = tee(self._pipe[0], w, n) or 0
+        data = []
+        while 0 < m:
+            x = os.read(r, m)
+            data.append(x)
+            m -= len(x)
+        data = ''.join(data)
+        if len(data) < n:
+            # the parsers cannot continue after a gap.
+            print >>sys.stderr, 'splice: could not copy the data, stopped logging'
+            self.procs = []
+            self._close_pipe(self._tee)
+            self._tee = None
+        for proc in self.procs:
+            proc.feed(data)
+        return
+
+    # sends the pending data to a socket.
+    def flush(self, fd):
+        n = splice(self._pipe[0], fd, self.pending)
+        if n:
+            self.pending -= n
+        return n
+
+    def _close_pipe(self, (r,w)):
+        os.close(r)
+        os.close(w)
+        return
+
+    def close(self):
+        self._close_pipe(self._pipe)
+        if self._tee is not None:
+            self._close_pipe(self._tee)
+            self._tee = None
+        return
+
+
+##  Resolver
+##  (resolves hostnames in threads and caches the results)
+##
+class Resolver(object):
+
+    # getaddrinfo() does not tell the ttl of a record.
+    TTL = 300
+
+    def __init__(self, loop=None, ttl=None):
+        self.loop = loop or get_event_loop()
+        self.ttl = ttl or self.TTL
+        # (host, port) -> (expires, addr)
+        self._cache = {}
+        # (host, port) -> [callback, ...]
+        self._waiting = {}
+        return
+
+    # calls callback(addr, error) when the address is resolved.
+    def resolve(self, (host, port), callback):
+        try:
+            socket.inet_aton(host)
+            callback((host, port), None)
+            return
+        except socket.error:
+            pass
+        key = (host, port)
+        if key in self._cache:
+            (expires, addr) = self._cache[key]
+            if time.time() < expires:
+                callback(addr, None)
+                return
+            del self._cache[key]
+        if key in self._waiting:
+            self._waiting[key].append(callback)
+            return
+        self._waiting[key] = [callback]
+        thread = threading.Thread(target=self._lookup, args=(key,))
+        thread.daemon = True
+        thread.start()
+        return
+
+    def _lookup(self, key):
+        (addr, error) = (None, None)
+        try:
+            (host, port) = key
+            addr = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+        except socket.error, e:
+            error = e
+        self.loop.call_soon_threadsafe(self._resolved, key, addr, error)
+        return
+
+    def _resolved(self, key, addr, error):
+        if addr is not None:
+            self._cache[key] = (time.time()+self.ttl, addr)
+        for callback in self._waiting.pop(key, []):
+            callback(addr, error)
+        return
+
+
+##  PooledConnection
+##
+class PooledConnection(Dispatcher):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.expires = None
+        self._timer = None
+        Dispatcher.__init__(self, loop=pool.loop)
+        return
+
+    def connect(self, addr):
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        Dispatcher.connect(self, addr)
+        return
+
+    def readable(self):
+        return self.connected
+
+    def handle_connect(self):
+        self.expires = time.time()+self.pool.max_idle
+        self._timer = self.loop.call_later(self.pool.max_idle, self._expire)
+        self.pool._connected(self)
+        return
+
+    # the server does not send anything first,
+    # so this is the end of the connection.
+    def handle_read(self):
+        self.handle_close()
+        return
+
+    def _expire(self):
+        self._timer = None
+        self.handle_close(failed=False)
+        return
+
+    # a connection that is dropped before it expires counts as a failure
+    # so that the pool does not keep reconnecting to a broken server.
+    def handle_close(self, failed=True):
+        self.close()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.pool._closed(self, failed)
+        return
+
+    # takes the socket out to give it to a Client.
+    def detach(self):
+        sock = self.socket
+        self.loop.remove(self)
+        self.socket = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return sock
+
+
+##  UpstreamPool
+##  (keeps connections to the upstream server ready)
+##
+class UpstreamPool(object):
+
+    # servers drop connections that do not log in for a while.
+    MAX_IDLE = 20
+    # seconds to wait before connecting again after a failure.
+    RETRY = 5
+
+    def __init__(self, addr, size, resolver, loop=None, max_idle=None):
+        self.addr = addr
+        self.size = size
+        self.resolver = resolver
+        self.loop = loop or get_event_loop()
+        self.max_idle = max_idle or self.MAX_IDLE
+        self._idle = collections.deque()
+        self._connecting = 0
+        self._retry = None
+        self.fill()
+        return
 
-    def _special_34(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 4:
-            self._pop()
-            n = toint(arg[0])
-            self._push(self._bytes, n)
-        return True
+    def fill(self):
+        # after a failure, it waits for the retry.
+        while self._retry is None and len(self._idle)+self._connecting < self.size:
+            self._connecting += 1
+            conn = PooledConnection(self)
+            self.resolver.resolve(self.addr, lambda addr, error, conn=conn:
+                                  self._resolved(conn, addr, error))
+        return
 
-    def _special_3c(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 4:
-            self._pop()
-            n = toint(arg[0])
-            self._push(self._bytes, n*3)
-        return True
+    def _resolved(self, conn, addr, error):
+        if addr is None:
+            conn.handle_close()
+            return
+        try:
+            conn.connect(addr)
+        except socket.error:
+            # a literal address is resolved at once and may fail right here.
+            conn.handle_close()
+        return
 
-    def _special_68(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 2:
-            self._pop()
-            self._push(self._special_68_2, toshort(arg[0]))
-        return True
-    def _special_68_2(self, c, arg):
-        if arg[0]:
-            arg[0] -= 1
-            self._push(self._slotdata)
-        else:
-            self._pop()
-        return False
+    # returns a connected socket or None.
+    def get(self):
+        now = time.time()
+        sock = None
+        while self._idle:
+            conn = self._idle.popleft()
+            if now < conn.expires:
+                sock = conn.detach()
+                break
+            conn.handle_close(failed=False)
+        self.fill()
+        return sock
+
+    def _connected(self, conn):
+        self._connecting -= 1
+        self._idle.append(conn)
+        return
 
-    def _special_83(self, c, arg):
-        self._pop()
-        self._push(self._bytes, ord(c))
-        return True
+    def _closed(self, conn, failed):
+        if conn in self._idle:
+            self._idle.remove(conn)
+        elif conn.expires is None:
+            self._connecting -= 1
+        if self._retry is not None: return
+        if failed:
+            self._retry = self.loop.call_later(self.RETRY, self._refill)
+        else:
+            self.fill()
+        return
 
-    def _special_fa(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 2:
-            self._pop()
-            self._push(self._bytes, toshort(arg[0]))
-        return True
-    
-    ENCHANTABLE_ITEMS = set([
-        0x103, #Flint and steel
-        0x105, #Bow
-        0x15A, #Fishing rod
-        0x167, #Shears
+    def _refill(self):
+        self._retry = None
+        self.fill()
+        return
 
-        #TOOLS
-        #sword, shovel, pickaxe, axe, hoe
-        0x10C, 0x10D, 0x10E, 0x10F, 0x122, #WOOD
-        0x110, 0x111, 0x112, 0x113, 0x123, #STONE
-        0x10B, 0x100, 0x101, 0x102, 0x124, #IRON
-        0x114, 0x115, 0x116, 0x117, 0x125, #DIAMOND
-        0x11B, 0x11C, 0x11D, 0x11E, 0x126, #GOLD
-        
-        #ARMOUR
-        #helmet, chestplate, leggings, boots
-        0x12A, 0x12B, 0x12C, 0x12D, #LEATHER
-        0x12E, 0x12F, 0x130, 0x131, #CHAIN
-        0x132, 0x133, 0x134, 0x135, #IRON
-        0x136, 0x137, 0x138, 0x139, #DIAMOND
-        0x13A, 0x13B, 0x13C, 0x13D  #GOLD
-        ])
-    def _slotdata(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 2:
-            self._pop()
-            bid = toshort(arg[0])
-            if 0 <= bid:
-                if bid in self.ENCHANTABLE_ITEMS:
-                    self._push(self._slotdata_extra)
-                self._push(self._bytes, 3)
-        return True
-    def _slotdata_extra(self, c, arg):
-        arg[0] += c
-        if len(arg[0]) == 2:
-            self._pop()
-            n = toshort(arg[0])
-            if 0 < n:
-                self._push(self._bytes, n)
-        return True
-    
-    def _metadata(self, c, arg):
-        c = ord(c)
-        if c == 0x7f:
-            self._pop()
-        else:
-            x = (c >> 5)
-            if x == 0:
-                self._push(self._bytes, 1)
-            elif x == 1:
-                self._push(self._bytes, 2)
-            elif x == 2:
-                self._push(self._bytes, 4)
-            elif x == 3:
-                self._push(self._bytes, 4)
-            elif x == 4:
-                self._push(self._str16)
-            elif x == 5:
-                self._push(self._bytes, 5)
-            elif x == 6:
-                self._push(self._bytes, 12)
-            else:
-                raise self.ProtocolError('invalid metadata: %r' % c)
-        return True
-        
-    def _main(self, c, arg):
-        if self.debugfp is not None:
-            print >>self.debugfp, 'main: %02x' % ord(c)
-        c = ord(c)
-        if c == 0x00:
-            self._push(self._bytes, 4)
-        elif c == 0x01:
-            self._push(self._special_01)
-        elif c == 0x02:
-            self._push(self._str16)
-        elif c == 0x03:
-            self._push(self._special_03)
-        elif c == 0x04:
-            self._push(self._special_04)
-        elif c == 0x05:
-            self._push(self._bytes, 10)
-        elif c == 0x06:
-            self._push(self._special_06)
-        elif c == 0x07:
-            self._push(self._bytes, 9)
-        elif c == 0x08:
-            self._push(self._special_08)
-        elif c == 0x09:
-            self._push(self._special_09)
-        elif c == 0x0a:
-            self._push(self._bytes, 1)
-        elif c == 0x0b:
-            self._push(self._special_0b)
-        elif c == 0x0c:
-            self._push(self._bytes, 9)
-        elif c == 0x0d:
-            self._push(self._special_0d)
-        elif c == 0x0e:
-            self._push(self._bytes, 11)
-        elif c == 0x0f:
-            self._push(self._slotdata)
-            self._push(self._bytes, 10)
-        elif c == 0x10:
-            self._push(self._bytes, 2)
-        elif c == 0x11:
-            self._push(self._bytes, 14)
-        elif c == 0x12:
-            self._push(self._bytes, 5)
-        elif c == 0x13:
-            self._push(self._bytes, 5)
-        elif c == 0x14:
-            self._push(self._bytes, 16)
-            self._push(self._str16)
-            self._push(self._bytes, 4)
-        elif c == 0x15:
-            self._push(self._bytes, 24)
-        elif c == 0x16:
-            self._push(self._bytes, 8)
-        elif c == 0x17:
-            self._push(self._special_17)
-            self._push(self._bytes, 17)
-        elif c == 0x18:
-            self._push(self._metadata)
-            self._push(self._special_18)
-        elif c == 0x19:
-            self._push(self._bytes, 16)
-            self._push(self._str16)
-            self._push(self._bytes, 4)
-        elif c == 0x1a:
-            self._push(self._bytes, 18)
-        elif c == 0x1b:
-            self._push(self._bytes, 18)
-        elif c == 0x1c:
-            self._push(self._bytes, 10)
-        elif c == 0x1d:
-            self._push(self._bytes, 4)
-        elif c == 0x1e:
-            self._push(self._bytes, 4)
-        elif c == 0x1f:
-            self._push(self._bytes, 7)
-        elif c == 0x20:
-            self._push(self._bytes, 6)
-        elif c == 0x21:
-            self._push(self._bytes, 9)
-        elif c == 0x22:
-            self._push(self._bytes, 18)
-        elif c == 0x23:
-            self._push(self._bytes, 5)
-        elif c == 0x26:
-            self._push(self._bytes, 5)
-        elif c == 0x27:
-            self._push(self._bytes, 8)
-        elif c == 0x28:
-            self._push(self._metadata)
-            self._push(self._bytes, 4)
-        elif c == 0x29:
-            self._push(self._bytes, 8)
-        elif c == 0x2a:
-            self._push(self._bytes, 5)
-        elif c == 0x2b:
-            self._push(self._bytes, 8)
-        elif c == 0x32:
-            self._push(self._bytes, 9)
-        elif c == 0x33:
-            self._push(self._special_33)
-        elif c == 0x34:
-            self._push(self._special_34)
-            self._push(self._bytes, 10)
-        elif c == 0x35:
-            self._push(self._bytes, 11)
-        elif c == 0x36:
-            self._push(self._bytes, 12)
-        elif c == 0x3c:
-            self._push(self._special_3c)
-            self._push(self._bytes, 28)
-        elif c == 0x3d:
-            self._push(self._bytes, 17)
-        elif c == 0x46:
-            self._push(self._bytes, 2)
-        elif c == 0x47:
-            self._push(self._bytes, 17)
-        elif c == 0x64:
-            self._push(self._bytes, 1)
-            self._push(self._str16)
-            self._push(self._bytes, 2)
-        elif c == 0x65:
-            self._push(self._bytes, 1)
-        elif c == 0x66:
-            self._push(self._slotdata)
-            self._push(self._bytes, 7)
-        elif c == 0x67:
-            self._push(self._slotdata)
-            self._push(self._bytes, 3)
-        elif c == 0x68:
-            self._push(self._special_68)
-            self._push(self._bytes, 1)
-        elif c == 0x69:
-            self._push(self._bytes, 5)
-        elif c == 0x6a:
-            self._push(self._bytes, 4)
-        elif c == 0x6b:
-            self._push(self._slotdata)
-            self._push(self._bytes, 2)
-        elif c == 0x6c:
-            self._push(self._bytes, 2)
-        elif c == 0x82:
-            self._push(self._str16)
-            self._push(self._str16)
-            self._push(self._str16)
-            self._push(self._str16)
-            self._push(self._bytes, 10)
-        elif c == 0x83:
-            self._push(self._special_83, 4)
-            self._push(self._bytes, 4)            
-        elif c == 0x84:
-            self._push(self._bytes, 23)
-        elif c == 0xc8:
-            self._push(self._bytes, 5)
-        elif c == 0xc9:
-            self._push(self._bytes, 3)
-            self._push(self._str16)
-        elif c == 0xca:
-            self._push(self._bytes, 4)
-        elif c == 0xfa:
-            self._push(self._special_fa)
-            self._push(self._str16)
-        elif c == 0xfe:
-            pass
-        elif c == 0xff:
-            self._push(self._str16)
-        else:
-            raise self.ProtocolError('invalid packet: %r' % c)
-        return True
-    
 
-##  MCLogger
+##  Backends
 ##
-class MCLogger(MCParser):
-    
-    def __init__(self, fp, safemode=False):
-        MCParser.__init__(self, safemode=safemode)
-        self.fp = fp
-        return
 
-    def _write(self, s):
-        line = time.strftime('%Y-%m-%d %H:%M:%S')+' '+s.encode('utf-8')
-        self.fp.write(line+'\n')
-        self.fp.flush()
-        print line
-        return
+# returns the username in a handshake packet (0x02),
+# '' for any other packet or None if the packet is incomplete.
+def parse_username(data):
+    if not data: return None
+    if data[0] != '\x02': return ''
+    if len(data) < 3: return None
+    n = SHORT.unpack_from(data, 1)[0]*2
+    if len(data) < 3+n: return None
+    return data[3:3+n].decode('utf-16be', 'replace').split(';')[0]
 
 
-##  MCServerLogger
+##  Backend
 ##
-class MCServerLogger(MCLogger):
+class Backend(object):
 
-    INTERVAL = 60
+    # number of failed checks before a backend is taken out.
+    FALL = 2
 
-    def __init__(self, fp, safemode=False,
-                 chat_text=True, time_update=True,
-                 player_pos=True, player_health=True,
-                 map_chunk_path=None, map_dimension=None):
-        MCLogger.__init__(self, fp, safemode=safemode)
-        self.rec_chat_text = chat_text
-        self.rec_time_update = time_update
-        self.rec_player_pos = player_pos
-        self.rec_player_health = player_health
-        self.map_chunk_path = map_chunk_path
-        self.map_dimension = map_dimension
-        self._dim = None
-        self._h = -1
+    def __init__(self, addr, pool=None):
+        self.addr = addr
+        self.pool = pool
+        self.active = 0
+        self.healthy = True
+        self._failures = 0
         return
-    
-    def _server_info(self, wtype, mode, dim, diff, height):
-        self._write(' ### server info: wtype=%r, mode=%d, dim=%d, diff=%d, height=%d' %
-                    (wtype, mode, dim, diff, height))
-        self._dim = dim
+
+    def checked(self, ok):
+        if ok:
+            self._failures = 0
+            if not self.healthy:
+                print >>sys.stderr, 'Backend up: %s:%d' % self.addr
+                self.healthy = True
+        else:
+            self._failures += 1
+            if self.healthy and self.FALL <= self._failures:
+                print >>sys.stderr, 'Backend down: %s:%d' % self.addr
+                self.healthy = False
         return
 
-    def _chat_text(self, s):
-        if not self.rec_chat_text: return
-        s = re.sub(ur'\xa7.', '', s)
-        self._write(s)
+
+##  HealthCheck
+##  (sends a server list ping (0xfe) and waits for the kick (0xff) reply)
+##
+class HealthCheck(Dispatcher):
+
+    def __init__(self, backend, resolver, timeout, loop=None):
+        self.backend = backend
+        self._done = False
+        Dispatcher.__init__(self, loop=loop)
+        self._timer = self.loop.call_later(timeout, self._finish, False)
+        resolver.resolve(backend.addr, self._resolved)
         return
 
-    def _time_update(self, t):
-        if not self.rec_time_update: return
-        (d,x) = divmod(t, 24000)
-        h = x/1000
-        if self._h != h:
-            self._h = h
-            self._write(' === day %d, %d:00' % (d, (h+8)%24))
+    def _resolved(self, addr, error):
+        if self._done: return
+        if addr is None:
+            self._finish(False)
+            return
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect(addr)
+        except socket.error:
+            # a literal address is resolved at once and may fail right here.
+            self._finish(False)
         return
 
-    def _player_pos(self, x, y, z):
-        if not self.rec_player_pos: return
-        p = (int(x), int(y), int(z))
-        self._write(' *** (%d, %d, %d)' % p)
+    def readable(self):
+        return self.connected
+
+    def handle_connect(self):
+        self.send('\xfe')
         return
-    
-    def _player_health(self, hp, food, sat):
-        if not self.rec_player_health: return
-        self._write(' +++ hp=%d, food=%d, sat=%.1f' % (hp, food, sat))
+
+    def handle_read(self):
+        data = self.recv(256)
+        if data:
+            self._finish(data[0] == '\xff')
         return
 
-    def _map_chunk(self, (x,z,g,b1,b2), nbytes):
-        #self._write(' ... chunk (%d,%d), g=%d, b1=0x%x, b2=0x%x' % (x,z,g,b1,b2))
-        self._chunk_key = '%d.%d' % (x>>9, z>>9)
-        self._chunk_info = pack('>iibHH', x,z,g,b1,b2)
-        self._chunk_data = ''
-        if (self.map_chunk_path is not None and
-            (self.map_dimension is not None and self.map_dimension == self._dim)):
-            self._push(self._map_chunk_2, nbytes)
-        else:
-            self._push(self._bytes, nbytes)
+    def handle_close(self):
+        self._finish(False)
         return
-    
-    def _map_chunk_2(self, c, arg):
-        arg[0] -= 1
-        self._chunk_data += c
-        if arg[0] == 0:
-            name = 'r.%s.maplog' % self._chunk_key
-            path = os.path.join(self.map_chunk_path, name)
-            fp = file(path, 'ab')
-            fp.write(self._chunk_info)
-            fp.write(pack('>i', len(self._chunk_data)))
-            fp.write(self._chunk_data)
-            fp.close()
-            self._pop()
-        return True
-    
 
-##  MCClientLogger
-##
-class MCClientLogger(MCLogger):
+    def handle_error(self):
+        self._finish(False)
+        return
 
-    INTERVAL = 60
+    def _finish(self, ok):
+        if self._done: return
+        self._done = True
+        self._timer.cancel()
+        self.close()
+        self.backend.checked(ok)
+        return
 
-    def __init__(self, fp, safemode=False,
-                 chat_text=True, player_pos=True):
-        MCLogger.__init__(self, fp, safemode=safemode)
-        self.rec_chat_text = chat_text
-        self.rec_player_pos = player_pos
-        self._t = -1
-        self._p = None
+
+##  Balancer
+##  (chooses a backend for each session)
+##
+class Balancer(object):
+
+    METHODS = ('leastconn', 'hash')
+    # seconds between health checks.
+    INTERVAL = 10
+    TIMEOUT = 5
+
+    def __init__(self, addrs, resolver, method='leastconn', pool_size=0,
+                 interval=None, loop=None):
+        assert method in self.METHODS, method
+        self.method = method
+        self.resolver = resolver
+        self.loop = loop or get_event_loop()
+        self.interval = interval or self.INTERVAL
+        self._turn = 0
+        self.backends = []
+        for addr in addrs:
+            pool = None
+            if pool_size:
+                pool = UpstreamPool(addr, pool_size, resolver, loop=self.loop)
+            self.backends.append(Backend(addr, pool))
+        self.loop.call_later(self.interval, self.check)
         return
 
-    def _chat_text(self, s):
-        if not self.rec_chat_text: return
-        s = re.sub(ur'\xa7.', '', s)
-        self._write('>> '+s)
+    # with the hash method, a user is sent to the same backend
+    # as long as it is healthy. (rendezvous hashing)
+    def choose(self, username=None):
+        backends = [ backend for backend in self.backends if backend.healthy ] or self.backends
+        if self.method == 'hash' and username:
+            key = username.lower().encode('utf-8')
+            backend = max(backends, key=lambda backend:
+                          zlib.crc32('%s@%s:%d' % ((key,)+backend.addr)) & 0xffffffff)
+        else:
+            # ties are broken in turn.
+            i = self._turn % len(backends)
+            self._turn += 1
+            backends = backends[i:]+backends[:i]
+            backend = min(backends, key=lambda backend: backend.active)
+        backend.active += 1
+        return backend
+
+    def check(self):
+        # the next round comes even if a check here goes wrong.
+        self.loop.call_later(self.interval, self.check)
+        for backend in self.backends:
+            HealthCheck(backend, self.resolver, self.TIMEOUT, loop=self.loop)
         return
 
-    def _player_pos(self, x, y, z):
-        if not self.rec_player_pos: return
-        t = int(time.time())
-        p = (int(x), int(y), int(z))
-        if t < self._t and (self._p is not None and dist(p, self._p) < 50): return
-        self._t = t + self.INTERVAL
-        self._p = p
-        self._write(' *** (%d, %d, %d)' % p)
+    def dump_stats(self):
+        for backend in self.backends:
+            print >>sys.stderr, 'BACKEND %s:%d: %s, active: %d' % (
+                backend.addr+('up' if backend.healthy else 'down', backend.active))
         return
 
 
 ##  Client
 ##
-class Client(asyncore.dispatcher):
+class Client(Dispatcher):
 
     BUFSIZE = 4906
 
     def __init__(self, proxy):
         self.proxy = proxy
-        self.sendbuffer = ""
-        asyncore.dispatcher.__init__(self)
+        self.sendbuffer = SendQueue()
+        self.sendbuffer_max = 0
+        # the socket is made when the address is resolved.
+        Dispatcher.__init__(self)
+        return
+
+    # takes a connected socket.
+    def attach(self, sock):
+        self.connected = True
+        self.set_socket(sock)
+        return
+
+    def connect(self, addr):
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        Dispatcher.connect(self, addr)
         return
 
     def handle_connect(self):
@@ -701,69 +2897,192 @@ class Client(asyncore.dispatcher):
         self.close()
         return
 
+    def readable(self):
+        return self.proxy.remote_readable()
+
     def handle_read(self):
-        self.proxy.remote_read(self.recv(self.BUFSIZE))
+        if self.proxy.relay_remote2local is not None:
+            self.proxy.remote_splice(self)
+        else:
+            self.proxy.remote_read(self.recv(self.BUFSIZE))
         return
 
     def remote_write(self, data):
-        self.sendbuffer += data
+        self.sendbuffer.append(data)
+        self.sendbuffer_max = max(self.sendbuffer_max, len(self.sendbuffer))
+        self.update()
         return
 
     def writable(self):
+        relay = self.proxy.relay_local2remote
+        if relay is not None:
+            return 0 < relay.pending
+        shaper = self.proxy.shaper_local2remote
+        if shaper is not None and shaper.blocked:
+            return False
         return 0 < len(self.sendbuffer)
 
     def handle_write(self):
-        n = self.send(self.sendbuffer)
-        self.sendbuffer = self.sendbuffer[n:]
+        relay = self.proxy.relay_local2remote
+        shaper = self.proxy.shaper_local2remote
+        if relay is not None:
+            relay.flush(self.fileno)
+        elif shaper is not None:
+            shaper.send(self, self.sendbuffer)
+        else:
+            n = self.send(self.sendbuffer.peek())
+            self.sendbuffer.consume(n)
+        # the proxy may resume reading.
+        self.proxy.update()
         return
 
 
 ##  Proxy
 ##
-class Proxy(asyncore.dispatcher):
+class Proxy(Dispatcher):
 
-    local2remotefp = None
-    remote2localfp = None
+    capture = None
     BUFSIZE = 4096
+    # reading from one side stops when the other side has this many
+    # bytes to send and starts again when it goes down to LOW_WATERMARK.
+    HIGH_WATERMARK = 1024*1024
+    LOW_WATERMARK = 256*1024
 
     def __init__(self, sock, session,
-                 plocal2remote, premote2local, delay=0):
+                 plocal2remote, premote2local, delay=0, jitter=0,
+                 high_watermark=None, low_watermark=None, relay=False,
+                 shapers=(None, None),
+                 resolver=None, pool=None, connect_timeout=None):
         self.plocal2remote = plocal2remote
         self.premote2local = premote2local
         self.session = session
         self.delay = delay
-        self._sendbuffer = ''
+        self.jitter = jitter
+        self._delay_local2remote = None
+        self._delay_remote2local = None
+        if delay or jitter:
+            loop = get_event_loop()
+            self._delay_local2remote = DelayQueue(loop, self._deliver_local2remote, delay, jitter)
+            self._delay_remote2local = DelayQueue(loop, self._deliver_remote2local, delay, jitter)
+        # the data is spliced only when it is passed as is.
+        (self.shaper_local2remote, self.shaper_remote2local) = shapers
+        self.resolver = resolver
+        self.pool = pool
+        self.connect_timeout = connect_timeout
+        self._connect_timer = None
+        self.balancer = None
+        self.backend = None
+        self._handshake = None
+        self.relay = (relay and not (delay or jitter) and self.capture is None and
+                      shapers == (None, None) and splice_available())
+        self.relay_local2remote = None
+        self.relay_remote2local = None
+        self.high_watermark = high_watermark or self.HIGH_WATERMARK
+        self.low_watermark = min(low_watermark or self.LOW_WATERMARK, self.high_watermark)
+        self._local_paused = False
+        self._remote_paused = False
+        self._paused_local = 0
+        self._paused_remote = 0
+        self._sendbuffer = SendQueue()
+        self._sendbuffer_max = 0
         self._sent_local2remote = 0
         self._sent_remote2local = 0
         self._client = None
+        self._started = time.time()
+        self.sendbuffer_remote_max = 0
         self.disp("BEGIN")
-        asyncore.dispatcher.__init__(self, sock)
+        if delay or jitter:
+            self.disp("(delay: %dms, jitter: %dms)" % (delay, jitter))
+        Dispatcher.__init__(self, sock)
         return
 
     # overridable methods
     def local2remote(self, s):
         for proc in self.plocal2remote:
             proc.feed(s)
-        if self.delay:
-            time.sleep(self.delay*.001)
         return s
     def remote2local(self, s):
         for proc in self.premote2local:
             proc.feed(s)
-        if self.delay:
-            time.sleep(self.delay*.001)
         return s
 
+    # chooses a backend. with the hash method, the connection
+    # waits for the handshake packet that has the username.
+    def connect_backend(self, balancer):
+        self.balancer = balancer
+        if balancer.method == 'hash':
+            # the client data is queued until then.
+            self.relay = False
+            self._handshake = ''
+            self._client = Client(self)
+        else:
+            self._connect_backend(None)
+        return
+
+    def _connect_backend(self, username):
+        self.backend = self.balancer.choose(username)
+        self.pool = self.backend.pool
+        self.connect_remote(self.backend.addr)
+        return
+
+    def _read_handshake(self, data):
+        self._handshake += data
+        username = parse_username(self._handshake)
+        if username is None and len(self._handshake) < 1024: return
+        self._handshake = None
+        if username:
+            self.disp("(user: %s)" % username.encode('utf-8'))
+        self._connect_backend(username)
+        return
+
     def connect_remote(self, addr):
-        assert not self._client, "already connected"
         self.addr = addr
         self.disp("(connecting to %s:%d)" % self.addr)
-        self._client = Client(self)
-        self._client.connect(addr)
+        if self.relay:
+            self.relay_local2remote = SpliceRelay(self.plocal2remote)
+            self.relay_remote2local = SpliceRelay(self.premote2local)
+        if self._client is None:
+            self._client = Client(self)
+        sock = None
+        if self.pool is not None and self.pool.addr == addr:
+            sock = self.pool.get()
+        if sock is not None:
+            self._client.attach(sock)
+            self.remote_connected()
+            return
+        if self.connect_timeout:
+            self._connect_timer = get_event_loop().call_later(
+                self.connect_timeout, self._remote_timeout)
+        if self.resolver is not None:
+            self.resolver.resolve(addr, self._remote_resolved)
+        else:
+            self._client.connect(addr)
+        return
+
+    def _remote_resolved(self, addr, error):
+        if self._client is None: return
+        if addr is None:
+            self.disp("(cannot resolve %s: %s)" % (self.addr[0], error))
+            self._client.handle_close()
+            return
+        try:
+            self._client.connect(addr)
+        except socket.error, e:
+            # a literal address is resolved at once and may fail right here.
+            self.disp("(cannot connect to %s:%d: %s)" % (addr[0], addr[1], e))
+            self._client.handle_close()
+        return
+
+    def _remote_timeout(self):
+        self._connect_timer = None
+        if self._client is not None and not self._client.connected:
+            self.disp("(connection timeout)")
+            self._client.handle_close()
         return
 
     def disconnect_remote(self):
         assert self._client, "not connected"
+        self.sendbuffer_remote_max = self._client.sendbuffer_max
         self._client.close()
         self._client = None
         return
@@ -773,44 +3092,137 @@ class Proxy(asyncore.dispatcher):
         return
 
     def remote_connected(self):
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
         self.disp("(connected to remote %s:%d)" % self.addr)
         return
 
     def remote_closed(self):
         self.disp("(closed by remote %s:%d)" % self.addr)
+        self.sendbuffer_remote_max = self._client.sendbuffer_max
         self._client = None
-        if not self._sendbuffer:
+        if not self._local_pending():
             self.handle_close()
         return
 
+    def _relay_pending(self):
+        return self.relay_remote2local is not None and 0 < self.relay_remote2local.pending
+
+    # returns True if there is still data to send to the local side.
+    def _local_pending(self):
+        return (0 < len(self._sendbuffer) or self._relay_pending() or
+                (self._delay_remote2local is not None and 0 < self._delay_remote2local.size))
+
+    def _throttled(self, n, paused):
+        if paused:
+            return self.low_watermark < n
+        return self.high_watermark <= n
+
+    # called by the client.
+    def remote_readable(self):
+        if self.relay_remote2local is not None:
+            return not self.relay_remote2local.pending
+        n = len(self._sendbuffer)
+        if self._delay_remote2local is not None:
+            n += self._delay_remote2local.size
+        paused = self._throttled(n, self._remote_paused)
+        if paused and not self._remote_paused:
+            self._paused_remote += 1
+        self._remote_paused = paused
+        return not paused
+
+    def readable(self):
+        if self.relay_local2remote is not None:
+            # the remote socket must be connected before splicing.
+            return (self._client is not None and self._client.connected and
+                    not self.relay_local2remote.pending)
+        paused = False
+        if self._client is not None:
+            n = len(self._client.sendbuffer)
+            if self._delay_local2remote is not None:
+                n += self._delay_local2remote.size
+            paused = self._throttled(n, self._local_paused)
+        if paused and not self._local_paused:
+            self._paused_local += 1
+        self._local_paused = paused
+        return not paused
+
     def remote_read(self, data):
         if data:
-            if self.remote2localfp is not None:
-                self.remote2localfp.write(data)
+            if self.capture is not None:
+                self.capture.write(self.session, REMOTE2LOCAL, data)
             self._sent_remote2local += len(data)
             data = self.remote2local(data)
             if data:
-                self._sendbuffer += data
+                if self._delay_remote2local is not None:
+                    self._delay_remote2local.put(data)
+                else:
+                    self._deliver_remote2local(data)
+        return
+
+    def _deliver_remote2local(self, data):
+        self._sendbuffer.append(data)
+        self._sendbuffer_max = max(self._sendbuffer_max, len(self._sendbuffer))
+        self.update()
+        return
+
+    # called by the client.
+    def remote_splice(self, client):
+        n = self.relay_remote2local.fill(client.fileno)
+        if n == 0:
+            client.handle_close()
+        elif n:
+            self._sent_remote2local += n
+            self.update()
         return
 
     def handle_read(self):
+        if self.relay_local2remote is not None:
+            n = self.relay_local2remote.fill(self.fileno)
+            if n == 0:
+                self.handle_close()
+            elif n:
+                self._sent_local2remote += n
+                self._client.update()
+            return
         data = self.recv(self.BUFSIZE)
         if data:
             data = self.local2remote(data)
             self._sent_local2remote += len(data)
-            if self.local2remotefp is not None:
-                self.local2remotefp.write(data)
-            if data and self._client is not None:
-                self._client.remote_write(data)
+            if self.capture is not None:
+                self.capture.write(self.session, LOCAL2REMOTE, data)
+            if data:
+                if self._delay_local2remote is not None:
+                    self._delay_local2remote.put(data)
+                else:
+                    self._deliver_local2remote(data)
+            if self._handshake is not None:
+                self._read_handshake(data)
+        return
+
+    def _deliver_local2remote(self, data):
+        if self._client is not None:
+            self._client.remote_write(data)
         return
 
     def writable(self):
-        return 0 < len(self._sendbuffer)
+        if self.shaper_remote2local is not None and self.shaper_remote2local.blocked:
+            return False
+        return 0 < len(self._sendbuffer) or self._relay_pending()
 
     def handle_write(self):
-        n = self.send(self._sendbuffer)
-        self._sendbuffer = self._sendbuffer[n:]
-        if not self._sendbuffer and self._client is None:
+        if self.relay_remote2local is not None:
+            self.relay_remote2local.flush(self.fileno)
+        elif self.shaper_remote2local is not None:
+            self.shaper_remote2local.send(self, self._sendbuffer)
+        else:
+            n = self.send(self._sendbuffer.peek())
+            self._sendbuffer.consume(n)
+        if self._client is not None:
+            # the client may resume reading.
+            self._client.update()
+        elif not self._local_pending():
             self.handle_close()
         return
 
@@ -819,52 +3231,368 @@ class Proxy(asyncore.dispatcher):
             self.disp("(closed by local)")
             self.disconnect_remote()
         self.close()
+        metrics.session_closed(self)
+        for relay in (self.relay_local2remote, self.relay_remote2local):
+            if relay is not None:
+                relay.close()
+        self.relay_local2remote = self.relay_remote2local = None
+        for queue in (self._delay_local2remote, self._delay_remote2local):
+            if queue is not None:
+                queue.close()
+        for shaper in (self.shaper_local2remote, self.shaper_remote2local):
+            if shaper is not None:
+                shaper.close()
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        if self.backend is not None:
+            self.backend.active -= 1
+            self.backend = None
+        for proc in self.plocal2remote+self.premote2local:
+            proc.close()
+        if self.capture is not None:
+            self.capture.close_stream(self.session)
         self.disp('sent: local2remote: %r, remote2local: %r' %
                   (self._sent_local2remote, self._sent_remote2local))
+        self.dump_stats()
         self.disp("END")
         return
 
+    # returns the bytes sent in each direction.
+    def get_sent(self):
+        return (self._sent_local2remote, self._sent_remote2local)
+
+    # returns the bytes waiting to be sent to each side.
+    def get_sendbuffer(self):
+        remote = 0
+        if self._client is not None:
+            remote = len(self._client.sendbuffer)
+        return (len(self._sendbuffer), remote)
+
+    def dump_stats(self):
+        t = max(time.time()-self._started, 0.001)
+        self.disp('rate: local2remote: %.1f KB/s, remote2local: %.1f KB/s' %
+                  (self._sent_local2remote/t/1024, self._sent_remote2local/t/1024))
+        if self._client is not None:
+            self.sendbuffer_remote_max = self._client.sendbuffer_max
+        self.disp('sendbuffer max: local: %r, remote: %r' %
+                  (self._sendbuffer_max, self.sendbuffer_remote_max))
+        self.disp('paused: local: %r, remote: %r' %
+                  (self._paused_local, self._paused_remote))
+        if self.shaper_local2remote is not None:
+            self.disp('tokens: local2remote: %s' % self.shaper_local2remote)
+        if self.shaper_remote2local is not None:
+            self.disp('tokens: remote2local: %s' % self.shaper_remote2local)
+        for proc in self.plocal2remote:
+            proc.dump_stats(lambda s: self.disp('local2remote: '+s))
+        for proc in self.premote2local:
+            proc.dump_stats(lambda s: self.disp('remote2local: '+s))
+        return
+
 
 ##  Server
 ##
-class Server(asyncore.dispatcher):
 
-    def __init__(self, port, destaddr, bindaddr="127.0.0.1", delay=0):
-        asyncore.dispatcher.__init__(self)
+# not defined in the socket module of Python 2.
+# the value differs among the platforms; only Linux's is known here.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+if SO_REUSEPORT is None and sys.platform.startswith('linux'):
+    SO_REUSEPORT = 15
+
+class Server(Dispatcher):
+
+    def __init__(self, port, destaddr, bindaddr="127.0.0.1", delay=0, jitter=0,
+                 profiles=None,
+                 high_watermark=None, low_watermark=None, relay=False,
+                 reuse_port=False, counter=None,
+                 session_rate=(None, None), global_rate=(None, None), global_buckets=None,
+                 connect_timeout=10, pool_size=0,
+                 backends=None, balance='leastconn'):
+        Dispatcher.__init__(self)
         self.destaddr = destaddr
         self.delay = delay
+        self.jitter = jitter
+        # a list of (delay, jitter) assigned to the sessions in turn.
+        self.profiles = profiles
+        self.relay = relay
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        # a multiprocessing.Value shared by the workers.
+        self.counter = counter
+        # bytes per second for (local2remote, remote2local).
+        self.session_rate = session_rate
+        # the buckets shared by the sessions. the workers share
+        # theirs, given as global_buckets.
+        if global_buckets is None:
+            global_buckets = [ TokenBucket(rate) if rate else None
+                               for rate in global_rate ]
+        self.global_buckets = global_buckets
+        self.connect_timeout = connect_timeout
+        self.resolver = Resolver(loop=self.loop)
+        self.pool = None
+        self.balancer = None
+        if backends and 1 < len(backends):
+            self.balancer = Balancer(backends, self.resolver, method=balance,
+                                     pool_size=pool_size, loop=self.loop)
+        elif pool_size:
+            self.pool = UpstreamPool(destaddr, pool_size, self.resolver, loop=self.loop)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.set_reuse_addr()
+        if reuse_port:
+            if SO_REUSEPORT is None:
+                raise ValueError('SO_REUSEPORT is not supported on %s' % sys.platform)
+            # every worker binds the same port and the kernel
+            # distributes the connections among them.
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self.bind((bindaddr, port))
-        self.listen(1)
+        self.listen(socket.SOMAXCONN)
         self.session = 0
         print >>sys.stderr, "Listening: %s:%d" % (bindaddr, port)
         return
 
+    # an error while accepting a session must not close the listening socket.
+    def handle_error(self):
+        self.log_error()
+        return
+
+    def next_session(self):
+        if self.counter is None:
+            session = self.session
+            self.session += 1
+        else:
+            lock = self.counter.get_lock()
+            lock.acquire()
+            try:
+                session = self.counter.value
+                self.counter.value = session+1
+            finally:
+                lock.release()
+        return session
+
+    def create_shapers(self):
+        shapers = []
+        for (rate, shared) in zip(self.session_rate, self.global_buckets):
+            buckets = []
+            if rate:
+                buckets.append(TokenBucket(rate))
+            if shared is not None:
+                buckets.append(shared)
+            if buckets:
+                shapers.append(Shaper(buckets))
+            else:
+                shapers.append(None)
+        return tuple(shapers)
+
     def handle_accept(self):
-        (conn, (addr,port)) = self.accept()
+        x = self.accept()
+        if x is None: return
+        (conn, (addr,port)) = x
         print >>sys.stderr, "Accepted:", addr
-        (clientloggers, serverloggers) = self.create_proxy(conn, self.session)
-        proxy = Proxy(conn, self.session, clientloggers, serverloggers, delay=self.delay)
-        proxy.connect_remote(self.destaddr)
-        self.session += 1
+        metrics.accepts += 1
+        session = self.next_session()
+        (delay, jitter) = (self.delay, self.jitter)
+        if self.profiles:
+            (delay, jitter) = self.profiles[session % len(self.profiles)]
+        (clientloggers, serverloggers) = self.create_proxy(conn, session)
+        proxy = Proxy(conn, session, clientloggers, serverloggers,
+                      delay=delay, jitter=jitter,
+                      high_watermark=self.high_watermark, low_watermark=self.low_watermark,
+                      relay=self.relay, shapers=self.create_shapers(),
+                      resolver=self.resolver, pool=self.pool,
+                      connect_timeout=self.connect_timeout)
+        if self.balancer is not None:
+            proxy.connect_backend(self.balancer)
+        else:
+            proxy.connect_remote(self.destaddr)
         return
 
     def create_proxy(self, conn, session):
         return ([], [])
 
 
+##  Metrics
+##  (counters exported in the Prometheus text format)
+##
+class Metrics(object):
+
+    def __init__(self):
+        self.accepts = 0
+        self.protocol_errors = 0
+        self.deactivations = 0
+        # totals of the closed sessions.
+        self._sent = [0, 0]
+        self._packets = {}
+        return
+
+    def session_closed(self, proxy):
+        (l2r, r2l) = proxy.get_sent()
+        self._sent[LOCAL2REMOTE] += l2r
+        self._sent[REMOTE2LOCAL] += r2l
+        self._add_packets(self._packets, proxy)
+        return
+
+    # packets are counted only when the parser collects statistics (-s).
+    def _add_packets(self, packets, proxy):
+        for (direction, procs) in ((LOCAL2REMOTE, proxy.plocal2remote),
+                                   (REMOTE2LOCAL, proxy.premote2local)):
+            for proc in procs:
+                stats = getattr(proc, 'stats', None)
+                if not stats: continue
+                for (c, st) in stats.iteritems():
+                    try:
+                        x = packets[(direction, c)]
+                    except KeyError:
+                        x = packets[(direction, c)] = [0, 0]
+                    x[0] += st[0]
+                    x[1] += st[1]
+        return
+
+    def render(self, loop):
+        proxies = [ disp for disp in loop.dispatchers() if isinstance(disp, Proxy) ]
+        sent = self._sent[:]
+        sendbuffer = [0, 0]
+        packets = dict( (k, v[:]) for (k, v) in self._packets.iteritems() )
+        for proxy in proxies:
+            (l2r, r2l) = proxy.get_sent()
+            sent[LOCAL2REMOTE] += l2r
+            sent[REMOTE2LOCAL] += r2l
+            (local, remote) = proxy.get_sendbuffer()
+            sendbuffer[0] += local
+            sendbuffer[1] += remote
+            self._add_packets(packets, proxy)
+        directions = ('local2remote', 'remote2local')
+        lines = []
+        def metric(name, kind, values):
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (labels, v) in values:
+                if labels:
+                    labels = '{%s}' % ','.join( '%s="%s"' % kv for kv in labels )
+                else:
+                    labels = ''
+                lines.append('%s%s %s' % (name, labels, v))
+            return
+        metric('mcproxy_sessions_active', 'gauge', [((), len(proxies))])
+        metric('mcproxy_accepts_total', 'counter', [((), self.accepts)])
+        metric('mcproxy_bytes_total', 'counter',
+               [ ((('direction', d),), sent[i]) for (i,d) in enumerate(directions) ])
+        metric('mcproxy_sendbuffer_bytes', 'gauge',
+               [ ((('side', 'local'),), sendbuffer[0]),
+                 ((('side', 'remote'),), sendbuffer[1]) ])
+        latency = loop.latency
+        lines.append('# TYPE mcproxy_loop_iteration_seconds histogram')
+        n = 0
+        for (bound, count) in zip(latency.bounds+('+Inf',), latency.counts):
+            n += count
+            lines.append('mcproxy_loop_iteration_seconds_bucket{le="%s"} %d' % (bound, n))
+        lines.append('mcproxy_loop_iteration_seconds_sum %r' % latency.total)
+        lines.append('mcproxy_loop_iteration_seconds_count %d' % n)
+        metric('mcproxy_parser_protocol_errors_total', 'counter', [((), self.protocol_errors)])
+        metric('mcproxy_parser_deactivations_total', 'counter', [((), self.deactivations)])
+        metric('mcproxy_packets_total', 'counter',
+               [ ((('direction', directions[d]), ('id', '0x%02x' % c)), v[0])
+                 for ((d,c),v) in sorted(packets.iteritems()) ])
+        metric('mcproxy_packet_bytes_total', 'counter',
+               [ ((('direction', directions[d]), ('id', '0x%02x' % c)), v[1])
+                 for ((d,c),v) in sorted(packets.iteritems()) ])
+        return '\n'.join(lines)+'\n'
+
+metrics = Metrics()
+
+
+##  MetricsConnection
+##
+class MetricsConnection(Dispatcher):
+
+    MAX_REQUEST = 8192
+
+    def __init__(self, sock, loop):
+        self._request = ''
+        self._response = SendQueue()
+        Dispatcher.__init__(self, sock, loop=loop)
+        return
+
+    def readable(self):
+        return not self._response
+
+    def writable(self):
+        return 0 < len(self._response)
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if not data: return
+        self._request += data
+        if '\r\n\r\n' not in self._request and len(self._request) < self.MAX_REQUEST: return
+        try:
+            (method, path, _) = self._request.split('\r\n', 1)[0].split(' ', 2)
+        except ValueError:
+            (method, path) = (None, None)
+        if method == 'GET' and path.split('?')[0] == '/metrics':
+            (status, body) = ('200 OK', metrics.render(self.loop))
+        else:
+            (status, body) = ('404 Not Found', 'not found\n')
+        self._response.append('HTTP/1.0 %s\r\n'
+                              'Content-Type: text/plain; version=0.0.4\r\n'
+                              'Content-Length: %d\r\n'
+                              'Connection: close\r\n\r\n' % (status, len(body)))
+        self._response.append(body)
+        return
+
+    def handle_write(self):
+        n = self.send(self._response.peek())
+        self._response.consume(n)
+        if not self._response:
+            self.close()
+        return
+
+
+##  MetricsServer
+##  (serves /metrics over HTTP on the proxy's loop)
+##
+class MetricsServer(Dispatcher):
+
+    def __init__(self, port, bindaddr="127.0.0.1", loop=None):
+        Dispatcher.__init__(self, loop=loop)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((bindaddr, port))
+        self.listen(socket.SOMAXCONN)
+        print >>sys.stderr, "Metrics: http://%s:%d/metrics" % (bindaddr, port)
+        return
+
+    def handle_accept(self):
+        x = self.accept()
+        if x is None: return
+        MetricsConnection(x[0], self.loop)
+        return
+
+    def handle_error(self):
+        self.log_error()
+        return
+
+
 ##  MCProxyServer
 ##
 class MCProxyServer(Server):
+
+    RING_SIZE = 16*1024*1024
     
-    def __init__(self, port, destaddr, output, bindaddr="127.0.0.1", delay=0,
+    def __init__(self, port, destaddr, output, bindaddr="127.0.0.1", delay=0, jitter=0,
+                 profiles=None,
                  safemode=True,
                  chat_text=True, time_update=True,
                  player_pos=True, player_health=True,
-                 map_chunk_path=None, map_dimension=None):
-        Server.__init__(self, port, destaddr, bindaddr=bindaddr, delay=delay)
+                 map_chunk_path=None, map_dimension=None,
+                 parser_process=False,
+                 high_watermark=None, low_watermark=None, relay=False,
+                 reuse_port=False, counter=None,
+                 session_rate=(None, None), global_rate=(None, None), global_buckets=None,
+                 connect_timeout=10, pool_size=0,
+                 backends=None, balance='leastconn', echo=True,
+                 columns=None, decimation=()):
         self.output = output
+        self.decimation = decimation
+        self.echo = echo
+        self.columns = columns
         self.safemode = safemode
         self.chat_text = chat_text
         self.time_update = time_update
@@ -872,86 +3600,418 @@ class MCProxyServer(Server):
         self.player_health = player_health
         self.map_chunk_path = map_chunk_path
         self.map_dimension = map_dimension
+        self.ring = None
+        self.parser_process = None
+        if parser_process:
+            # the parser process is forked before the listening socket is made.
+            self.ring = RingBuffer(self.RING_SIZE)
+            self.parser_process = ParserProcess(self.ring, self.create_loggers)
+            self.parser_process.start()
+        else:
+            self._flush_logs()
+        Server.__init__(self, port, destaddr, bindaddr=bindaddr,
+                        delay=delay, jitter=jitter, profiles=profiles,
+                        high_watermark=high_watermark, low_watermark=low_watermark,
+                        relay=relay, reuse_port=reuse_port, counter=counter,
+                        session_rate=session_rate, global_rate=global_rate,
+                        global_buckets=global_buckets,
+                        connect_timeout=connect_timeout, pool_size=pool_size,
+                        backends=backends, balance=balance)
+        return
+
+    def _flush_logs(self):
+        LogWriter.flush_all(due=True)
+        get_event_loop().call_later(LogWriter.FLUSH_INTERVAL, self._flush_logs)
+        return
+
+    # called at exit. writes out the buffered logs.
+    def finish(self):
+        if self.parser_process is not None:
+            self.parser_process.stop()
+        LogWriter.flush_all()
         return
 
     def create_proxy(self, conn, session):
-        path = time.strftime(self.output)
-        fp = file(path, 'a')
-        print >>sys.stderr, "output:", path
+        if self.ring is not None:
+            return ([RingFeeder(self.ring, session, LOCAL2REMOTE)],
+                    [RingFeeder(self.ring, session, REMOTE2LOCAL)])
+        return self.create_loggers(session)
+
+    def create_loggers(self, session):
+        # all the sessions write into one file.
+        writer = LogWriter.open(self.output, echo=self.echo)
+        fp = writer.fp
+        sinks = [TextSink(fp, writer=writer, session=session)]
+        if self.columns is not None:
+            sinks.append(ColumnSink(ColumnWriter.open(self.columns), session))
+        # both directions report the same player.
+        decimator = PositionDecimator(*self.decimation)
         serverlogger = MCServerLogger(fp, safemode=self.safemode,
                                       chat_text=self.chat_text,
                                       time_update=self.time_update,
                                       player_pos=self.player_pos,
                                       player_health=self.player_health,
                                       map_chunk_path=self.map_chunk_path,
-                                      map_dimension=self.map_dimension)
+                                      map_dimension=self.map_dimension,
+                                      mob_spawn=(self.columns is not None),
+                                      sinks=sinks, decimator=decimator)
         clientlogger = MCClientLogger(fp, safemode=self.safemode,
                                       chat_text=self.chat_text,
-                                      player_pos=self.player_pos)
+                                      player_pos=self.player_pos,
+                                      sinks=sinks, decimator=decimator)
         return ([clientlogger], [serverlogger])
     
     
+##  Batch parsing of captured streams
+##
+
+# parses one capture and writes the log lines into a file.
+def parse_capture((index, path, outpath, safemode, start, end, decimation)):
+    # the lines are merged in order later, so they are not echoed here.
+    fp = file(outpath, 'w')
+    if is_capture(path):
+        parse_capture_records(fp, path, safemode, start, end, decimation, echo=False)
+    else:
+        parse_capture_raw(fp, path, safemode, decimation, echo=False)
+    fp.close()
+    print >>sys.stderr, 'parsed: %r' % path
+    return (index, outpath)
+
+def parse_capture_raw(fp, path, safemode, decimation=(), echo=True):
+    decimator = PositionDecimator(*decimation)
+    sinks = [TextSink(fp, echo=echo)]
+    if 'client' in os.path.basename(path):
+        parser = MCClientLogger(fp, safemode=safemode, sinks=sinks, decimator=decimator)
+    else:
+        parser = MCServerLogger(fp, safemode=safemode, sinks=sinks, decimator=decimator)
+    # raw captures have no timing information.
+    mtime = os.stat(path).st_mtime
+    parser.clock = lambda: mtime
+    capture = file(path, 'rb')
+    while 1:
+        data = capture.read(65536)
+        if not data: break
+        parser.feed(data)
+    capture.close()
+    parser.close()
+    return
+
+def parse_capture_records(fp, path, safemode, start, end, decimation=(), echo=True):
+    reader = CaptureReader(path)
+    now = [0]
+    clock = lambda: now[0]
+    parsers = {}
+    decimators = {}
+    # the parsers share one writer to keep the lines in order.
+    writer = LogWriter(fp, echo=echo)
+    for (session, direction, t, data) in reader.read(start, end):
+        key = (session, direction)
+        try:
+            parser = parsers[key]
+        except KeyError:
+            sinks = [TextSink(fp, writer=writer)]
+            if session not in decimators:
+                decimators[session] = PositionDecimator(*decimation)
+            decimator = decimators[session]
+            if direction == LOCAL2REMOTE:
+                parser = MCClientLogger(fp, safemode=safemode, sinks=sinks, decimator=decimator)
+            else:
+                parser = MCServerLogger(fp, safemode=safemode, sinks=sinks, decimator=decimator)
+            parser.clock = clock
+            # the reader resumes a stream from a packet boundary
+            # before start, but only the events after it are wanted.
+            parser.start = start
+            parsers[key] = parser
+        now[0] = t
+        parser.feed(data)
+    for parser in parsers.itervalues():
+        parser.close()
+    reader.close()
+    return
+
+# parses captures in parallel and merges the logs in time order.
+def parse_captures(paths, out, nprocs=None, safemode=True, start=None, end=None,
+                   decimation=()):
+    import tempfile
+    tmpdir = tempfile.mkdtemp(prefix='mcproxy')
+    tasks = [ (i, path, os.path.join(tmpdir, '%d.txt' % i), safemode, start, end, decimation)
+              for (i,path) in enumerate(paths) ]
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        results = pool.map(parse_capture, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    # held positions can be up to PositionDecimator.DELAY seconds
+    # late in a log, so the lines are put in order within that.
+    def lines((i, outpath)):
+        fp = file(outpath)
+        held = []
+        (last, limit) = (None, '')
+        for (j,line) in enumerate(fp):
+            # a line starts with its timestamp.
+            stamp = line[:19]
+            heapq.heappush(held, (stamp, i, j, line))
+            if stamp != last:
+                last = stamp
+                try:
+                    t = time.mktime(time.strptime(stamp, '%Y-%m-%d %H:%M:%S'))
+                    limit = time.strftime('%Y-%m-%d %H:%M:%S',
+                                          time.localtime(t-PositionDecimator.DELAY-1))
+                except ValueError:
+                    pass
+            while held[0][0] < limit:
+                yield heapq.heappop(held)
+        while held:
+            yield heapq.heappop(held)
+        fp.close()
+        os.remove(outpath)
+        return
+    for (_,_,_,line) in heapq.merge(*map(lines, results)):
+        out.write(line)
+    os.rmdir(tmpdir)
+    return
+
+
+# '2012-04-10 12:34:56' or seconds since the epoch.
+def parse_time(v):
+    if not v: return None
+    try:
+        return float(v)
+    except ValueError:
+        return time.mktime(time.strptime(v, '%Y-%m-%d %H:%M:%S'))
+
+# prints the rows of a table in column files.
+def dump_columns(paths, out, table, player=None, start=None, end=None):
+    out.write('\t'.join(ColumnReader.columns(table))+'\n')
+    for path in paths:
+        reader = ColumnReader(path)
+        for row in reader.read(table, start=start, end=end, player=player):
+            t = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row[0]))
+            out.write('\t'.join([t]+[ unicode(v).encode('utf-8') for v in row[1:] ])+'\n')
+        reader.close()
+    return
+
+# dump the statistics of the active sessions.
+def dump_stats(signum, frame):
+    for obj in get_event_loop().dispatchers():
+        if isinstance(obj, Proxy):
+            obj.dump_stats()
+        elif isinstance(obj, Server) and obj.balancer is not None:
+            obj.balancer.dump_stats()
+    return
+
+# runs func(worker) in nworkers forked processes and waits for them.
+def run_workers(nworkers, func):
+    pids = []
+    for worker in xrange(nworkers):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                func(worker)
+                status = 0
+            except KeyboardInterrupt:
+                status = 0
+            except:
+                traceback.print_exc()
+            os._exit(status)
+        pids.append(pid)
+    def forward(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+        return
+    for name in ('SIGTERM', 'SIGUSR1'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), forward)
+    while pids:
+        try:
+            (pid, _) = os.wait()
+            pids.remove(pid)
+        except KeyboardInterrupt:
+            # the workers get SIGINT from the terminal, too.
+            pass
+        except OSError, e:
+            if e.errno != errno.EINTR: raise
+    return
+
 # main
 def main(argv):
     import getopt
     def usage():
-        print 'usage: %s [-d] [-o output] [-p port] [-t testfile] [-U] [-M path] [-L delay] hostname:port' % argv[0]
+        print 'usage: %s [-d] [-o output] [-p port] [-U] [-M path] [-L delay[,jitter]] [-B high[,low]] [-R] [-w nworkers] [-K up,down] [-G up,down] [-c timeout] [-W poolsize] [-m leastconn|hash] [-H port] [-P] [-s] [-q] [-C columns] [-Z interval,distance[,tolerance]] hostname:port ...' % argv[0]
+        print '       %s [-d] [-o output] [-j nprocs] [-T start,end] [-Z interval,distance[,tolerance]] -t testfile ...' % argv[0]
+        print '       %s [-T start,end] -E table[:player] -t columnfile ...' % argv[0]
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'do:b:p:t:UM:S:D:L:')
+        (opts, args) = getopt.getopt(argv[1:], 'do:b:p:t:j:T:UM:S:D:L:B:Rw:K:G:c:W:m:H:PsqC:E:Z:')
     except getopt.GetoptError:
         return usage()
     debug = 0
-    output = 'mclog-%Y%m%d.txt'
+    output = None
     bindaddr = '127.0.0.1'
     listen = 25565
-    testfile = None
+    testfiles = []
+    nprocs = None
+    (start, end) = (None, None)
     safemode = True
     map_chunk_path = None
     map_dimension = None
-    delay = 0
+    profiles = []
+    parser_process = False
+    (high_watermark, low_watermark) = (None, None)
+    relay = False
+    nworkers = 0
+    session_rate = global_rate = (None, None)
+    connect_timeout = 10
+    pool_size = 0
+    balance = 'leastconn'
+    metrics_port = None
+    echo = True
+    columns = None
+    (table, player) = (None, None)
+    decimation = ()
     for (k, v) in opts:
         if k == '-d': debug += 1
         elif k == '-o': output = v
         elif k == '-b': bindaddr = v
         elif k == '-p': listen = int(v)
-        elif k == '-t': testfile = file(v, 'rb')
+        elif k == '-t': testfiles.extend(glob.glob(v) or [v])
+        elif k == '-j': nprocs = int(v)
+        elif k == '-T': (start, end) = [ parse_time(x) for x in (v.split(',')+[''])[:2] ]
         elif k == '-U': safemode = False
         elif k == '-M': map_chunk_path = v
         elif k == '-D': map_dimension = int(v)
-        elif k == '-L': delay = int(v)
-    if testfile is not None:
-        MCParser.debugfp = sys.stderr
-        parser = MCServerLogger(sys.stdout)
-        #parser = MCClientLogger(sys.stdout)
-        while 1:
-            data = testfile.read(4096)
-            if not data: break
-            parser.feed(data)
-        testfile.close()
+        elif k == '-L':
+            # in milliseconds. repeated for different sessions.
+            (delay, jitter) = [ int(x or 0) for x in (v.split(',')+[''])[:2] ]
+            profiles.append((delay, jitter))
+        elif k == '-B':
+            # in kilobytes.
+            (high_watermark, low_watermark) = [ int(x)*1024 if x else None
+                                                for x in (v.split(',')+[''])[:2] ]
+        elif k == '-R': relay = True
+        elif k == '-w': nworkers = int(v)
+        elif k in ('-K', '-G'):
+            # in kilobytes per second. 0 or empty is unlimited.
+            rates = tuple( int(float(x)*1024) if x else None
+                           for x in (v.split(',')+[''])[:2] )
+            if k == '-K':
+                session_rate = rates
+            else:
+                global_rate = rates
+        elif k == '-c': connect_timeout = float(v)
+        elif k == '-W': pool_size = int(v)
+        elif k == '-m':
+            if v not in Balancer.METHODS: return usage()
+            balance = v
+        elif k == '-H': metrics_port = int(v)
+        elif k == '-P': parser_process = True
+        elif k == '-s': MCParser.collect_stats = True
+        elif k == '-q': echo = False
+        elif k == '-C': columns = v
+        elif k == '-E':
+            (table, player) = (v.split(':', 1)+[None])[:2]
+            if player is not None:
+                player = player.decode('utf-8')
+        elif k == '-Z':
+            # seconds, blocks and blocks. 0,0 logs every position.
+            decimation = tuple( float(x) for x in v.split(',') if x )
+    if testfiles and table is not None:
+        try:
+            ColumnReader.columns(table)
+        except KeyError:
+            return usage()
+        dump_columns(testfiles, sys.stdout, table, player=player, start=start, end=end)
+        return
+    if testfiles:
+        if debug:
+            MCParser.debugfp = sys.stderr
+        if output is None:
+            parse_captures(testfiles, sys.stdout, nprocs=nprocs, safemode=safemode,
+                           start=start, end=end, decimation=decimation)
+        else:
+            out = file(output, 'w')
+            parse_captures(testfiles, out, nprocs=nprocs, safemode=safemode,
+                           start=start, end=end, decimation=decimation)
+            out.close()
         return
     if not args: return usage()
+    if nworkers and SO_REUSEPORT is None:
+        print >>sys.stderr, '-w needs SO_REUSEPORT, which is not supported on %s' % sys.platform
+        return 100
+    if output is None:
+        output = 'mclog-%Y%m%d.txt'
     if map_chunk_path is not None:
         try:
             os.makedirs(map_chunk_path)
         except OSError:
             pass
-    x = args.pop(0)
-    if ':' in x:
-        (hostname,port) = x.split(':')
-        port = int(port)
-    else:
-        hostname = x
-        port = 25565
+    backends = []
+    for x in args:
+        if ':' in x:
+            (hostname,port) = x.split(':')
+            port = int(port)
+        else:
+            hostname = x
+            port = 25565
+        backends.append((hostname, port))
+    (hostname, port) = backends[0]
     if debug:
         MCParser.debugfp = file('parser.log', 'w')
-        Proxy.local2remotefp = file('client.log', 'wb')
-        Proxy.remote2localfp = file('server.log', 'wb')
-    MCProxyServer(listen, (hostname, port), output, delay=delay,
-                  bindaddr=bindaddr, safemode=safemode,
-                  map_chunk_path=map_chunk_path,
-                  map_dimension=map_dimension)
-    asyncore.loop()
+    counter = None
+    global_buckets = None
+    if nworkers:
+        counter = multiprocessing.Value('i', 0)
+        # -G limits all the workers together.
+        global_buckets = [ SharedTokenBucket(rate) if rate else None
+                           for rate in global_rate ]
+    def run(worker=None):
+        if debug:
+            path = 'capture-%Y%m%d-%H%M%S'
+            if worker is not None:
+                path += '-'+str(worker)
+            Proxy.capture = CaptureWriter(time.strftime(path+'.mcc'))
+        server = MCProxyServer(listen, (hostname, port), output,
+                               profiles=profiles,
+                               bindaddr=bindaddr, safemode=safemode,
+                               map_chunk_path=map_chunk_path,
+                               map_dimension=map_dimension,
+                               parser_process=parser_process,
+                               high_watermark=high_watermark,
+                               low_watermark=low_watermark,
+                               relay=relay,
+                               reuse_port=(worker is not None),
+                               counter=counter,
+                               session_rate=session_rate,
+                               global_rate=global_rate,
+                               global_buckets=global_buckets,
+                               connect_timeout=connect_timeout,
+                               pool_size=pool_size,
+                               backends=backends,
+                               balance=balance,
+                               echo=echo,
+                               columns=columns,
+                               decimation=decimation)
+        if metrics_port is not None:
+            # each worker has its own port.
+            MetricsServer(metrics_port+(worker or 0), bindaddr=bindaddr)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, dump_stats)
+        # leave the loop so that the buffered logs are written.
+        signal.signal(signal.SIGTERM, lambda signum, frame: get_event_loop().stop())
+        try:
+            get_event_loop().run()
+        finally:
+            server.finish()
+        return
+    if nworkers:
+        run_workers(nworkers, run)
+    else:
+        run()
     return
 
 if __name__ == '__main__': sys.exit(main(sys.argv))